@@ -11,6 +11,7 @@ bl_info = {
 import importlib
 
 module_names = (
+    "profiling",
     "process_model",
     "icon_render",
     "bake_lighting",
@@ -5,6 +5,7 @@ from timeit import default_timer as timer
 
 from .process_model import IS_TRANSPARENT
 from .materials import get_lutb_force_white_mat
+from .profiling import stage, count_geometry
 
 WHITE_AMBIENT = "LUTB_WHITE_AMBIENT"
 
@@ -93,164 +94,181 @@ class LUTB_OT_bake_lighting(bpy.types.Operator):
 
     def execute(self, context):
         start = timer()
+        with stage("bake_lighting") as profile:
+            scene = context.scene
+            scene_override = scene.copy()
+
+            render = scene_override.render
+            cycles = scene_override.cycles
+            render.engine = "CYCLES"
+            cycles.use_denoising = False
+            cycles.bake_type = "COMBINED"
+            cycles.caustics_reflective = False
+            cycles.caustics_refractive = False
+            render.bake.use_pass_direct = True
+            render.bake.use_pass_indirect = True
+            render.bake.use_pass_diffuse = True
+            render.bake.use_pass_glossy = False
+            render.bake.use_pass_transmission = True
+            render.bake.use_pass_emit = True
+            render.bake.target = "VERTEX_COLORS"
+
+            cycles.use_fast_gi = True
+            cycles.ao_bounces_render = scene.lutb_bake_fast_gi_bounces
+
+            cycles.device = "GPU" if scene.lutb_process_use_gpu else "CPU"
+            cycles.samples = scene.lutb_bake_samples
+
+            if scene.lutb_bake_use_white_ambient:
+                if not (world := bpy.data.worlds.get(WHITE_AMBIENT)):
+                    world = bpy.data.worlds.new(WHITE_AMBIENT)
+                    world.color = (1.0, 1.0, 1.0)
+                scene_override.world = world
+
+            emission_strength = scene.lutb_bake_glow_strength
+
+            ao_only_world_override = None
+            if scene.lutb_bake_ao_only:
+                cycles.max_bounces = 0
+                cycles.fast_gi_method = "ADD"
+                cycles.samples = scene.lutb_bake_ao_samples
+
+                ao_only_world_override = bpy.data.worlds.new("AO_ONLY")
+                ao_only_world_override.color = (0.0, 0.0, 0.0)
+                ao_only_world_override.light_settings.ao_factor = 1.0
+                ao_only_world_override.light_settings.distance = 5.0
+                scene_override.world = ao_only_world_override
+
+                emission_strength *= scene.lutb_bake_glow_multiplier
+
+            hidden_objects = []
+            for obj in list(scene.collection.all_objects):
+                if obj.type == "MESH" and obj.get(IS_TRANSPARENT) and not obj.hide_render:
+                    obj.hide_render = True
+                    hidden_objects.append(obj)
+
+            target_objects = scene.collection.all_objects
+            if scene.lutb_bake_selected_only:
+                target_objects = context.selected_objects
+
+            old_active_obj = context.object
+            old_selected_objects = context.selected_objects
+            baked_objects = []
+            for obj in list(target_objects):
+                if obj.type != "MESH" or obj.get(IS_TRANSPARENT):
+                    continue
+                if not obj.name in context.view_layer.objects:
+                    self.report({"WARNING"}, f"Skipping \"{obj.name}\". (not in viewlayer)")
+                    continue
 
-        scene = context.scene
-        scene_override = scene.copy()
-
-        render = scene_override.render
-        cycles = scene_override.cycles
-        render.engine = "CYCLES"
-        cycles.use_denoising = False
-        cycles.bake_type = "COMBINED"
-        cycles.caustics_reflective = False
-        cycles.caustics_refractive = False
-        render.bake.use_pass_direct = True
-        render.bake.use_pass_indirect = True
-        render.bake.use_pass_diffuse = True
-        render.bake.use_pass_glossy = False
-        render.bake.use_pass_transmission = True
-        render.bake.use_pass_emit = True
-        render.bake.target = "VERTEX_COLORS"
-
-        cycles.use_fast_gi = True
-        cycles.ao_bounces_render = scene.lutb_bake_fast_gi_bounces
-
-        cycles.device = "GPU" if scene.lutb_process_use_gpu else "CPU"
-        cycles.samples = scene.lutb_bake_samples
-
-        if scene.lutb_bake_use_white_ambient:
-            if not (world := bpy.data.worlds.get(WHITE_AMBIENT)):
-                world = bpy.data.worlds.new(WHITE_AMBIENT)
-                world.color = (1.0, 1.0, 1.0)
-            scene_override.world = world
-
-        emission_strength = scene.lutb_bake_glow_strength
-
-        ao_only_world_override = None
-        if scene.lutb_bake_ao_only:
-            cycles.max_bounces = 0
-            cycles.fast_gi_method = "ADD"
-            cycles.samples = scene.lutb_bake_ao_samples
-
-            ao_only_world_override = bpy.data.worlds.new("AO_ONLY")
-            ao_only_world_override.color = (0.0, 0.0, 0.0)
-            ao_only_world_override.light_settings.ao_factor = 1.0
-            ao_only_world_override.light_settings.distance = 5.0
-            scene_override.world = ao_only_world_override
-
-            emission_strength *= scene.lutb_bake_glow_multiplier
-
-        hidden_objects = []
-        for obj in list(scene.collection.all_objects):
-            if obj.type == "MESH" and obj.get(IS_TRANSPARENT) and not obj.hide_render:
-                obj.hide_render = True
-                hidden_objects.append(obj)
-
-        target_objects = scene.collection.all_objects
-        if scene.lutb_bake_selected_only:
-            target_objects = context.selected_objects
-
-        old_active_obj = context.object
-        old_selected_objects = context.selected_objects
-        for obj in list(target_objects):
-            if obj.type != "MESH" or obj.get(IS_TRANSPARENT):
-                continue
-            if not obj.name in context.view_layer.objects:
-                self.report({"WARNING"}, f"Skipping \"{obj.name}\". (not in viewlayer)")
-                continue
-
-            mesh = obj.data
-
-            if not mesh.materials:
-                self.report({"WARNING"}, f"Skipping \"{obj.name}\". (has no materials)")
-                continue
-
-            triangulate_mods = [mod for mod in obj.modifiers if mod.type == "TRIANGULATE"]
-            for modifier in triangulate_mods:
-                modifier.show_render = False
-            if not triangulate_mods or not obj.modifiers[-1] in triangulate_mods:
-                modifier = obj.modifiers.new("Triangulate", "TRIANGULATE")
-                modifier.show_render = False
-            
-            if vc_lit := mesh.vertex_colors.get("Lit"):
-                mesh.vertex_colors.active_index = mesh.vertex_colors.keys().index(vc_lit.name)
-
-            other_lod_colls = set()
-            for lod_collection in obj.users_collection:
-                for collection in bpy.data.collections:
-                    if lod_collection.name in collection.children:
-                        other_lod_colls |= set(collection.children) - {lod_collection,}
-
-            for other_lod_coll in list(other_lod_colls):
-                if other_lod_coll.hide_render:
-                    other_lod_colls.remove(other_lod_coll)
-                else:
-                    other_lod_coll.hide_render = True
-
-            old_material = mesh.materials[0]
-            if scene.lutb_bake_use_mat_override:
-                mesh.materials[0] = scene.lutb_bake_mat_override
-            elif scene.lutb_bake_force_to_white:
-                if material := get_lutb_force_white_mat(self):
-                    mesh.materials[0] = material
-
-            if mesh.materials[0].use_nodes:
-                for node in mesh.materials[0].node_tree.nodes:
-                    if node.type == "BSDF_PRINCIPLED":
-                        node.inputs['Emission Strength'].default_value = emission_strength
+                mesh = obj.data
 
-            bpy.ops.object.select_all(action="DESELECT")
-            obj.select_set(True)
-            context.view_layer.objects.active = obj
-
-            context_override = context.copy()
-            context_override["scene"] = scene_override
-            try:
-                bpy.ops.object.bake(context_override)
-            except RuntimeError as e:
-                if "is not enabled for rendering" in str(e):
-                    self.report({"WARNING"}, f"Skipping \"{obj.name}\". (not enabled for rendering)")
+                if not mesh.materials:
+                    self.report({"WARNING"}, f"Skipping \"{obj.name}\". (has no materials)")
                     continue
-                else:
-                    raise
-            finally:
-                mesh.materials[0] = old_material
-
-                for other_lod_coll in other_lod_colls:
-                    other_lod_coll.hide_render = False
-
-            has_edge_split_modifier = "EDGE_SPLIT" in {mod.type for mod in obj.modifiers}
-            if scene.lutb_bake_smooth_lit and not has_edge_split_modifier:
-                bpy.ops.object.mode_set(mode="VERTEX_PAINT")
-                if mesh.use_paint_mask or mesh.use_paint_mask_vertex:
-                    bpy.ops.paint.vert_select_all(action="SELECT")
-                bpy.ops.paint.vertex_color_smooth()
-                bpy.ops.object.mode_set(mode="OBJECT")
-
-            if vc_lit and (vc_alpha := mesh.vertex_colors.get("Alpha")):
-                n_loops = len(mesh.loops)
-
-                lit_data = np.empty(n_loops * 4)
-                alpha_data = np.empty(n_loops * 4)
-
-                vc_lit.data.foreach_get("color", lit_data)
-                vc_alpha.data.foreach_get("color", alpha_data)
-                lit_data = lit_data.reshape((n_loops, 4))
-                lit_data[:, 3] = alpha_data.reshape((n_loops, 4))[:, 0]
-                vc_lit.data.foreach_set("color", lit_data.flatten())
-
-        bpy.data.scenes.remove(scene_override)
-
-        if ao_only_world_override:
-            bpy.data.worlds.remove(ao_only_world_override)
-
-        for obj in hidden_objects:
-            obj.hide_render = False
-
-        bpy.ops.object.select_all(action="DESELECT")
-        for obj in old_selected_objects:
-            obj.select_set(True)
-        context.view_layer.objects.active = old_active_obj
+
+                triangulate_mods = [mod for mod in obj.modifiers if mod.type == "TRIANGULATE"]
+                for modifier in triangulate_mods:
+                    modifier.show_render = False
+                if not triangulate_mods or not obj.modifiers[-1] in triangulate_mods:
+                    modifier = obj.modifiers.new("Triangulate", "TRIANGULATE")
+                    modifier.show_render = False
+
+                lit_alpha = None
+                if vc_lit := mesh.vertex_colors.get("Lit"):
+                    mesh.vertex_colors.active_index = mesh.vertex_colors.keys().index(vc_lit.name)
+
+                    # without an Alpha layer, alpha was packed into Lit and the bake would overwrite it
+                    if not mesh.vertex_colors.get("Alpha"):
+                        lit_data = np.empty(len(mesh.loops) * 4, dtype=np.float32)
+                        vc_lit.data.foreach_get("color", lit_data)
+                        lit_alpha = lit_data[3::4].copy()
+
+                other_lod_colls = set()
+                for lod_collection in obj.users_collection:
+                    for collection in bpy.data.collections:
+                        if lod_collection.name in collection.children:
+                            other_lod_colls |= set(collection.children) - {lod_collection,}
+
+                for other_lod_coll in list(other_lod_colls):
+                    if other_lod_coll.hide_render:
+                        other_lod_colls.remove(other_lod_coll)
+                    else:
+                        other_lod_coll.hide_render = True
+
+                old_material = mesh.materials[0]
+                if scene.lutb_bake_use_mat_override:
+                    mesh.materials[0] = scene.lutb_bake_mat_override
+                elif scene.lutb_bake_force_to_white:
+                    if material := get_lutb_force_white_mat(self):
+                        mesh.materials[0] = material
+
+                if mesh.materials[0].use_nodes:
+                    for node in mesh.materials[0].node_tree.nodes:
+                        if node.type == "BSDF_PRINCIPLED":
+                            node.inputs['Emission Strength'].default_value = emission_strength
+
+                bpy.ops.object.select_all(action="DESELECT")
+                obj.select_set(True)
+                context.view_layer.objects.active = obj
+
+                context_override = context.copy()
+                context_override["scene"] = scene_override
+                try:
+                    bpy.ops.object.bake(context_override)
+                except RuntimeError as e:
+                    if "is not enabled for rendering" in str(e):
+                        self.report({"WARNING"}, f"Skipping \"{obj.name}\". (not enabled for rendering)")
+                        continue
+                    else:
+                        raise
+                finally:
+                    mesh.materials[0] = old_material
+
+                    for other_lod_coll in other_lod_colls:
+                        other_lod_coll.hide_render = False
+
+                baked_objects.append(obj)
+
+                has_edge_split_modifier = "EDGE_SPLIT" in {mod.type for mod in obj.modifiers}
+                if scene.lutb_bake_smooth_lit and not has_edge_split_modifier:
+                    bpy.ops.object.mode_set(mode="VERTEX_PAINT")
+                    if mesh.use_paint_mask or mesh.use_paint_mask_vertex:
+                        bpy.ops.paint.vert_select_all(action="SELECT")
+                    bpy.ops.paint.vertex_color_smooth()
+                    bpy.ops.object.mode_set(mode="OBJECT")
+
+                if vc_lit and (vc_alpha := mesh.vertex_colors.get("Alpha")):
+                    n_loops = len(mesh.loops)
+
+                    lit_data = np.empty(n_loops * 4, dtype=np.float32)
+                    alpha_data = np.empty(n_loops * 4, dtype=np.float32)
+
+                    vc_lit.data.foreach_get("color", lit_data)
+                    vc_alpha.data.foreach_get("color", alpha_data)
+                    lit_data[3::4] = alpha_data[0::4]
+                    vc_lit.data.foreach_set("color", lit_data)
+
+                elif lit_alpha is not None:
+                    lit_data = np.empty(len(mesh.loops) * 4, dtype=np.float32)
+                    vc_lit.data.foreach_get("color", lit_data)
+                    lit_data[3::4] = lit_alpha
+                    vc_lit.data.foreach_set("color", lit_data)
+
+            bpy.data.scenes.remove(scene_override)
+
+            if ao_only_world_override:
+                bpy.data.worlds.remove(ao_only_world_override)
+
+            for obj in hidden_objects:
+                obj.hide_render = False
+
+            bpy.ops.object.select_all(action="DESELECT")
+            for obj in old_selected_objects:
+                obj.select_set(True)
+            context.view_layer.objects.active = old_active_obj
+
+            profile["counts"].update(count_geometry(baked_objects))
 
         end = timer()
         print(f"finished bake lighting in {end - start:.2f}s")
@@ -0,0 +1,257 @@
+"""Convert whole folders of LDD models without opening the Blender UI.
+
+Every model is imported, processed, baked and saved to its own .blend file by a
+separate background Blender process, several of which run at the same time:
+
+    python batch_convert.py models/ --output out/ --brickdb path/to/res --jobs 8
+
+Inputs can be directories (searched for .lxf/.lxfml files) or manifests, which are
+text files listing one model path per line. Each .blend mirrors the model's path
+relative to its input folder (or manifest) in the output folder. A summary with
+per file timings and failures is written to batch_summary.json in the output folder.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MODEL_EXTENSIONS = (".lxf", ".lxfml")
+ADDON_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDON_NAME = os.path.basename(ADDON_DIR)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Batch convert LDD models to LU ready .blend files.")
+    parser.add_argument("inputs", nargs="+",
+        help="model files, directories containing models or manifests listing one model per line")
+    parser.add_argument("-o", "--output", required=True, help="directory the .blend files are written to")
+    parser.add_argument("--brickdb", required=True, help="path to the Brick DB (or luclient/res/)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+        help="number of Blender processes to run at the same time")
+    parser.add_argument("--threads", type=int, default=0,
+        help="render threads per Blender process (default: cores divided by jobs)")
+    parser.add_argument("--blender", default=os.environ.get("BLENDER", "blender"),
+        help="Blender executable (default: $BLENDER or blender)")
+    parser.add_argument("--lods", default="0,1,2,3", help="comma separated list of LODs to import")
+    parser.add_argument("--recursive", action="store_true", help="search input directories recursively")
+    parser.add_argument("--no-bake", action="store_true", help="skip baking lighting")
+    parser.add_argument("--overwrite", action="store_true", help="convert models whose .blend already exists")
+    parser.add_argument("--profile", action="store_true",
+        help="write per stage timings and memory usage of every model as JSON and Chrome trace files")
+    parser.add_argument("--timeout", type=float, default=None, help="seconds after which a model is given up")
+    parser.add_argument("--summary", default=None,
+        help="path of the summary JSON (default: <output>/batch_summary.json)")
+
+    # used by the driver to hand a single model to a background Blender process
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--result", default=None, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+# Returns (model, root) pairs, where root is the directory or manifest folder the model was
+# found in. Its path relative to root is mirrored in the output directory.
+def collect_models(inputs, recursive=False):
+    models = []
+    for path in inputs:
+        if os.path.isdir(path):
+            if recursive:
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    models += [(os.path.join(root, name), path) for name in sorted(files)
+                        if name.lower().endswith(MODEL_EXTENSIONS)]
+            else:
+                models += [(os.path.join(path, name), path) for name in sorted(os.listdir(path))
+                    if name.lower().endswith(MODEL_EXTENSIONS)]
+        elif path.lower().endswith(MODEL_EXTENSIONS):
+            models.append((path, os.path.dirname(path)))
+        else:
+            base = os.path.dirname(path)
+            with open(path, encoding="utf-8") as manifest:
+                for line in manifest:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        models.append((os.path.join(base, line), base))
+
+    # keep the first occurrence of every model
+    unique = {}
+    for model, root in models:
+        unique.setdefault(os.path.abspath(model), os.path.abspath(root))
+    return list(unique.items())
+
+
+def output_path(model, root, output):
+    relative = os.path.relpath(model, root)
+    # models outside of their root (e.g. "../x.lxf" in a manifest) go to the top of the output
+    if os.path.isabs(relative) or relative.split(os.sep)[0] == os.pardir:
+        relative = os.path.basename(model)
+    return os.path.join(output, os.path.splitext(relative)[0] + ".blend")
+
+
+# models writing to the same .blend (and .log) would overwrite each other while running in parallel
+def find_duplicate_outputs(models, output):
+    targets = {}
+    for model, root in models:
+        target = os.path.normcase(os.path.abspath(output_path(model, root, output)))
+        targets.setdefault(target, []).append(model)
+    return {target: sources for target, sources in targets.items() if len(sources) > 1}
+
+
+def run_driver(args):
+    models = collect_models(args.inputs, args.recursive)
+
+    duplicates = find_duplicate_outputs(models, args.output)
+    if duplicates:
+        print("error: several models would be written to the same file:")
+        for target, sources in duplicates.items():
+            print(f"  {target}: {', '.join(sources)}")
+        return 2
+
+    os.makedirs(args.output, exist_ok=True)
+
+    jobs = max(1, min(args.jobs, len(models) or 1))
+    threads = args.threads or max(1, (os.cpu_count() or 1) // jobs)
+
+    print(f"converting {len(models)} models with {jobs} Blender processes")
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(lambda model: convert_model(args, *model, threads), models))
+
+    failed = [result for result in results if result["status"] == "failed"]
+    summary = {
+        "models": len(results),
+        "converted": sum(result["status"] == "converted" for result in results),
+        "skipped": sum(result["status"] == "skipped" for result in results),
+        "failed": len(failed),
+        "jobs": jobs,
+        "seconds": time.perf_counter() - start,
+        "results": results,
+    }
+
+    summary_path = args.summary or os.path.join(args.output, "batch_summary.json")
+    with open(summary_path, "w", encoding="utf-8") as file:
+        json.dump(summary, file, indent=2)
+
+    print(f"finished {summary['converted']} models in {summary['seconds']:.2f}s, "
+        f"{summary['skipped']} skipped, {summary['failed']} failed")
+    for result in failed:
+        print(f"  {result['input']}: {result['error']}")
+    print(f"summary written to {summary_path}")
+
+    return 1 if failed else 0
+
+
+def convert_model(args, model, root, threads):
+    output = output_path(model, root, args.output)
+    result = {"input": model, "output": output, "status": "skipped", "seconds": 0.0, "stages": {}, "error": None}
+    if os.path.exists(output) and not args.overwrite:
+        return result
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    fd, result_path = tempfile.mkstemp(prefix="lutb_", suffix=".json")
+    os.close(fd)
+    command = [
+        args.blender, "--background", "--factory-startup", "--python-exit-code", "1",
+        "--threads", str(threads),
+        "--python", os.path.abspath(__file__), "--",
+        "--worker", model,
+        "--output", output,
+        "--brickdb", args.brickdb,
+        "--lods", args.lods,
+        "--result", result_path,
+    ]
+    if args.no_bake:
+        command.append("--no-bake")
+    if args.profile:
+        command.append("--profile")
+
+    start = time.perf_counter()
+    log_path = os.path.splitext(output)[0] + ".log"
+    try:
+        with open(log_path, "w", encoding="utf-8") as log:
+            process = subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, timeout=args.timeout)
+        # the result file stays empty if Blender died before the worker could write it
+        if os.path.getsize(result_path):
+            with open(result_path, encoding="utf-8") as file:
+                result.update(json.load(file))
+        if process.returncode or result["status"] != "converted":
+            result["status"] = "failed"
+            result["error"] = result["error"] or f"Blender exited with code {process.returncode}"
+    except subprocess.TimeoutExpired:
+        result["status"] = "failed"
+        result["error"] = f"timed out after {args.timeout}s"
+    except (OSError, ValueError) as e:
+        result["status"] = "failed"
+        result["error"] = result["error"] or f"{type(e).__name__}: {e}"
+    finally:
+        os.remove(result_path)
+
+    result["seconds"] = time.perf_counter() - start
+    result["log"] = log_path
+    print(f"[{result['status']}] {model} ({result['seconds']:.2f}s)")
+    return result
+
+
+def run_worker(args):
+    import bpy
+    import addon_utils
+
+    model = args.inputs[0]
+    result = {"status": "failed", "stages": {}, "error": None}
+
+    def stage(name, function, *args, **kwargs):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        result["stages"][name] = time.perf_counter() - start
+
+    try:
+        sys.path.insert(0, os.path.dirname(ADDON_DIR))
+        if not addon_utils.enable(ADDON_NAME, default_set=True):
+            raise RuntimeError(f"failed to enable the {ADDON_NAME} add-on")
+        bpy.context.preferences.addons[ADDON_NAME].preferences.brickdbpath = args.brickdb
+
+        lods = {lod.strip() for lod in args.lods.split(",")}
+        stage("import", bpy.ops.import_scene.importldd,
+            filepath=model,
+            importLOD0="0" in lods,
+            importLOD1="1" in lods,
+            importLOD2="2" in lods,
+            importLOD3="3" in lods,
+            overwriteScene=True,
+        )
+        stage("process", bpy.ops.lutb.process_model)
+        if not args.no_bake:
+            stage("bake", bpy.ops.lutb.bake_lighting)
+        stage("save", bpy.ops.wm.save_as_mainfile, filepath=os.path.abspath(args.output))
+
+        result["status"] = "converted"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+        print(f"failed to convert {model}: {result['error']}")
+
+    if args.profile and ADDON_NAME + ".profiling" in sys.modules:
+        profiling = sys.modules[ADDON_NAME + ".profiling"]
+        result["profile"] = os.path.splitext(os.path.abspath(args.output))[0] + ".profile.json"
+        profiling.profiler.save_json(result["profile"])
+        profiling.profiler.save_chrome_trace(profiling.chrome_trace_path(result["profile"]))
+
+    with open(args.result, "w", encoding="utf-8") as file:
+        json.dump(result, file)
+
+    return 0 if result["status"] == "converted" else 1
+
+
+def main():
+    # Blender passes the script its own arguments too, ours follow after "--"
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else sys.argv[1:]
+    args = parse_args(argv)
+    sys.exit(run_worker(args) if args.worker else run_driver(args))
+
+
+if __name__ == "__main__":
+    main()
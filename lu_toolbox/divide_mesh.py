@@ -1,51 +1,173 @@
-import bpy, bmesh
+import bpy
 import numpy as np
 
-def divide_mesh(context, mesh_obj, max_verts=65536, min_div_rate=0.1):
-    def divide_rec(obj):
-        mesh = obj.data
-        n_verts = len(mesh.vertices)
+from .join_mesh import read_mesh, read_split_normals, write_mesh
 
-        if n_verts < max_verts:
-            return []
+# Splits a mesh object into pieces with less than max_verts vertices each. Connected parts of the
+# mesh are kept together and packed into pieces by recursively splitting them at the median of
+# their centers, so pieces stay spatially compact. Parts that are too large on their own are split
+# by their faces the same way. The first piece stays on the object, the others are returned as new
+# objects in the same collections.
+def divide_mesh(context, mesh_obj, max_verts=65536):
+    mesh = mesh_obj.data
+    if len(mesh.vertices) < max_verts:
+        return []
 
-        buffer_co = np.empty(n_verts * 3)
-        mesh.vertices.foreach_get("co", buffer_co)
-        vecs = buffer_co.reshape((n_verts, 3))
-        mean = np.sum(vecs, axis=0) / n_verts
+    data = read_mesh(mesh)
+    co = data["co"]
+    n_verts = len(co)
+    n_polys = len(data["loop_start"])
+    loop_total = data["loop_total"]
 
-        bound_box = np.array(obj.bound_box)
-        target_axis = np.argmax((bound_box[0] - bound_box[6]) ** 2)
-        select = vecs[:,target_axis] < mean[target_axis]
+    # loops of all polygons in polygon order, and where each polygon starts in that order
+    poly_offsets = np.cumsum(loop_total) - loop_total
+    poly_loops = np.arange(loop_total.sum()) + np.repeat(data["loop_start"] - poly_offsets, loop_total)
+    loop_verts = data["vertex_index"][poly_loops]
 
-        bpy.ops.object.select_all(action="DESELECT")
-        obj.select_set(True)
-        context.view_layer.objects.active = obj
+    def face_loops(faces):
+        totals = loop_total[faces]
+        return np.arange(totals.sum()) + np.repeat(poly_offsets[faces] - (np.cumsum(totals) - totals), totals)
 
-        bpy.ops.object.mode_set(mode="EDIT")
-        bpy.ops.mesh.select_all(action="DESELECT")
+    components = connected_components(n_verts, data["edges"])
+    n_components = components.max() + 1
+    component_sizes = np.bincount(components, minlength=n_components)
+    component_centers = np.stack([
+        np.bincount(components, weights=co[:, axis], minlength=n_components) for axis in range(3)
+    ], axis=1) / component_sizes[:, None]
 
-        bm = bmesh.from_edit_mesh(mesh)
-        for vert, v_select in zip(bm.verts, select):
-            vert.select = v_select
-        bm.select_mode = {"VERT"}
-        bm.select_flush_mode()
-        bmesh.update_edit_mesh(mesh)
-        bm.free()
+    if n_polys:
+        face_centers = np.add.reduceat(co[loop_verts], poly_offsets) / loop_total[:, None]
+        face_components = components[loop_verts[poly_offsets]]
+    else:
+        face_centers = np.empty((0, 3))
+        face_components = np.empty(0, dtype=int)
 
-        bpy.ops.mesh.select_linked()
-        bpy.ops.mesh.separate()
-        bpy.ops.object.mode_set(mode="OBJECT")
+    component_chunks = np.full(n_components, -1)
+    face_chunks = np.full(n_polys, -1)
+    n_chunks = 0
 
-        new_obj = (set(context.selected_objects) - set((obj,))).pop()
+    oversized = []
+    stack = [np.arange(n_components)]
+    while stack:
+        group = stack.pop()
+        if component_sizes[group].sum() < max_verts:
+            component_chunks[group] = n_chunks
+            n_chunks += 1
+        elif len(group) == 1:
+            oversized.append(group[0])
+        else:
+            group = median_sorted(group, component_centers[group])
+            sizes = np.cumsum(component_sizes[group])
+            split = np.clip(np.searchsorted(sizes, sizes[-1] / 2) + 1, 1, len(group) - 1)
+            stack += [group[split:], group[:split]]
 
-        div_rate = len(new_obj.data.vertices) / n_verts
-        div_rate = min(div_rate, 1 - div_rate)
+    packed = component_chunks[face_components] >= 0
+    face_chunks[packed] = component_chunks[face_components[packed]]
 
-        if div_rate < min_div_rate:
-            raise Exception(f"fatal: failed to divide mesh: {div_rate} < {min_div_rate} (div_rate < min_div_rate)")
+    for component in oversized:
+        component_chunks[component] = n_chunks
+        stack = [np.where(face_components == component)[0]]
+        while stack:
+            faces = stack.pop()
+            if len(faces) == 1 or len(np.unique(loop_verts[face_loops(faces)])) < max_verts:
+                face_chunks[faces] = n_chunks
+                n_chunks += 1
+            else:
+                faces = median_sorted(faces, face_centers[faces])
+                split = len(faces) // 2
+                stack += [faces[split:], faces[:split]]
 
-        return divide_rec(obj) + divide_rec(new_obj) + [new_obj]
+    # vertices and edges which aren't part of any face go with the first piece of their component
+    in_face = np.zeros(n_verts, dtype=bool)
+    in_face[loop_verts] = True
+    loose_verts = np.where(~in_face)[0]
+    loose_vert_chunks = component_chunks[components[loose_verts]]
+
+    edge_in_face = np.zeros(len(data["edges"]), dtype=bool)
+    edge_in_face[data["edge_index"]] = True
+    loose_edges = np.where(~edge_in_face)[0]
+    loose_edge_chunks = component_chunks[components[data["edges"][loose_edges, 0]]]
+
+    split_normals = read_split_normals(mesh) if mesh.has_custom_normals else None
+    materials = list(mesh.materials)
+
+    def chunk_members(chunks, items):
+        order = np.argsort(chunks, kind="stable")
+        bounds = np.searchsorted(chunks[order], np.arange(n_chunks + 1))
+        return [items[order[bounds[i]:bounds[i + 1]]] for i in range(n_chunks)]
+
+    chunk_faces = chunk_members(face_chunks, np.arange(n_polys))
+    chunk_loose_verts = chunk_members(loose_vert_chunks, loose_verts)
+    chunk_loose_edges = chunk_members(loose_edge_chunks, loose_edges)
+
+    new_meshes = []
+    for faces, chunk_verts, chunk_edges in zip(chunk_faces, chunk_loose_verts, chunk_loose_edges):
+        loops = poly_loops[face_loops(faces)]
+        vertex_index = data["vertex_index"][loops]
+        edge_index = data["edge_index"][loops]
+
+        verts = np.unique(np.concatenate((vertex_index, data["edges"][chunk_edges].ravel(), chunk_verts)))
+        edges = np.unique(np.concatenate((edge_index, chunk_edges)))
+        totals = loop_total[faces]
+
+        new_meshes.append(write_mesh(mesh.name, {
+            "co": co[verts],
+            "edges": np.searchsorted(verts, data["edges"][edges]).astype(np.int32),
+            "use_edge_sharp": data["use_edge_sharp"][edges],
+            "use_seam": data["use_seam"][edges],
+            "vertex_index": np.searchsorted(verts, vertex_index).astype(np.int32),
+            "edge_index": np.searchsorted(edges, edge_index).astype(np.int32),
+            "loop_start": (np.cumsum(totals) - totals).astype(np.int32),
+            "loop_total": totals,
+            "use_smooth": data["use_smooth"][faces],
+            "material_index": data["material_index"][faces],
+            "select": data["select"][faces],
+            "bricks": None if data["bricks"] is None else data["bricks"][faces],
+            "uvs": {name: uv[loops] for name, uv in data["uvs"].items()},
+            "vcs": {name: vc[loops] for name, vc in data["vcs"].items()},
+        }, materials, mesh, None if split_normals is None else split_normals[loops]))
+
+    name = mesh.name
+    mesh_obj.data = new_meshes[0]
+    if mesh.users == 0:
+        bpy.data.meshes.remove(mesh)
+    new_meshes[0].name = name
+
+    new_objects = []
+    for new_mesh in new_meshes[1:]:
+        new_obj = mesh_obj.copy()
+        new_obj.data = new_mesh
+        for collection in mesh_obj.users_collection:
+            collection.objects.link(new_obj)
+        new_objects.append(new_obj)
 
-    new_objects = divide_rec(mesh_obj)
     return new_objects
+
+# Labels connected vertices with the same number from 0 to the number of components - 1. Trees
+# of vertices are hooked onto each other along edges and flattened by pointer jumping, which
+# takes a few passes over the edge arrays instead of a Python loop per vertex.
+def connected_components(n_verts, edges):
+    labels = np.arange(n_verts)
+    a, b = edges[:, 0], edges[:, 1]
+
+    while True:
+        label_a, label_b = labels[a], labels[b]
+        crossing = label_a != label_b
+        if not crossing.any():
+            break
+
+        label_a, label_b = label_a[crossing], label_b[crossing]
+        labels[np.maximum(label_a, label_b)] = np.minimum(label_a, label_b)
+
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+
+    return np.unique(labels, return_inverse=True)[1]
+
+# items ordered along the axis their centers spread out the most
+def median_sorted(items, centers):
+    axis = np.argmax(centers.max(axis=0) - centers.min(axis=0))
+    return items[np.argsort(centers[:, axis], kind="stable")]
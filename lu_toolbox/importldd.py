@@ -1,6 +1,6 @@
 # based on pyldd2obj by jonnysp and lxfml import plugin by sttng
 # modified by aronwk-aaron to work better with LU-Toolbox
-import bpy, bmesh
+import bpy
 import mathutils
 from bpy_extras.io_utils import (
     ImportHelper,
@@ -8,16 +8,19 @@ from bpy_extras.io_utils import (
 )
 
 import os
-import sys
+import json
 import math
-import time
+import mmap
+import zlib
 import struct
 import zipfile
-from xml.dom import minidom
+from xml.etree import ElementTree
 import uuid
 import random
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
+from .profiling import stage, count_geometry
 from .materials import (
     MATERIALS_OPAQUE,
     MATERIALS_TRANSPARENT,
@@ -92,6 +95,19 @@ class ImportLDDOps(Operator, ImportHelper):
         default=True,
     )
 
+    useCache: BoolProperty(
+        name="Use Geometry Cache",
+        description="Keep decoded brick geometry in a cache inside the Brick DB folder to speed up later imports",
+        default=True,
+    )
+
+    useInstancing: BoolProperty(
+        name="Instance Identical Parts",
+        description="Let rigid parts with the same design and colors share one mesh. "
+                    "Process Model makes them unique again where it needs to",
+        default=False,
+    )
+
     def execute(self, context):
         return convertldd_data(
             self,
@@ -102,7 +118,9 @@ class ImportLDDOps(Operator, ImportHelper):
             self.importLOD2,
             self.importLOD3,
             self.overwriteScene,
-            self.useNormals
+            self.useNormals,
+            self.useCache,
+            self.useInstancing
         )
 
 
@@ -123,7 +141,7 @@ def menu_func_import(self, context):
     self.layout.operator(ImportLDDOps.bl_idname, text="LEGO Exchange Format (.lxf/.lxfml)")
 
 
-def convertldd_data(self, context, filepath, importLOD0, importLOD1, importLOD2, importLOD3, overwriteScene, useNormals):
+def convertldd_data(self, context, filepath, importLOD0, importLOD1, importLOD2, importLOD3, overwriteScene, useNormals, useCache, useInstancing):
 
     preferences = context.preferences
     addon_prefs = preferences.addons[__package__].preferences
@@ -141,11 +159,10 @@ def convertldd_data(self, context, filepath, importLOD0, importLOD1, importLOD2,
 
     if os.path.isdir(primaryBrickDBPath):
         self.report({'INFO'}, 'Found DB folder.')
-        start = time.process_time()
-        setDBFolderVars(dbfolderlocation=primaryBrickDBPath)
-        converter.LoadDBFolder(dbfolderlocation=primaryBrickDBPath)
-        end = time.process_time()
-        self.report({'INFO'}, f'Time taken to load Brick DB: {end - start} seconds')
+        with stage("db_load") as profile:
+            setDBFolderVars(dbfolderlocation=primaryBrickDBPath)
+            converter.LoadDBFolder(dbfolderlocation=primaryBrickDBPath, useCache=useCache)
+        self.report({'INFO'}, f'Time taken to load Brick DB: {profile["wall"]:.2f} seconds')
 
     try:
         if overwriteScene:
@@ -157,66 +174,43 @@ def convertldd_data(self, context, filepath, importLOD0, importLOD1, importLOD2,
             for c in context.scene.collection.children:
                 context.scene.collection.children.unlink(c)
 
-        converter.LoadScene(filename=filepath)
+        with stage("scene_parse") as profile:
+            converter.LoadScene(filename=filepath)
+            profile["counts"]["bricks"] = len(converter.scene.Bricks)
         col = bpy.data.collections.new(converter.scene.Name)
         bpy.context.scene.collection.children.link(col)
 
-        if importLOD0:
-            start = time.process_time()
-            converter.Export(
-                filename=filepath,
-                lod='0',
-                parent_collection=col,
-                useNormals=useNormals
-            )
-            end = time.process_time()
-            self.report({'INFO'}, f'Time taken to Load LOD0: {end - start} seconds')
-        if importLOD1:
-            start = time.process_time()
-            converter.Export(
-                filename=filepath,
-                lod='1',
-                parent_collection=col,
-                useNormals=useNormals
-            )
-            end = time.process_time()
-            self.report({'INFO'}, f'Time taken to Load LOD1: {end - start} seconds')
-        if importLOD2:
-            start = time.process_time()
-            converter.Export(
-                filename=filepath,
-                lod='2',
-                parent_collection=col,
-                useNormals=useNormals
-            )
-            end = time.process_time()
-            self.report({'INFO'}, f'Time taken to Load LOD2: {end - start} seconds')
-        LOD3_exists = False
+        lods = [lod for lod, enabled in (('0', importLOD0), ('1', importLOD1), ('2', importLOD2)) if enabled]
         if importLOD3:
-            for dirpath, dirnames, filenames in os.walk(primaryBrickDBPath):
-                for dirname in dirnames:
-                    if dirname == "lod3":
-                        LOD3_exists = True
-            if LOD3_exists:
-                start = time.process_time()
+            if converter.database.hasLOD('3'):
+                lods.append('3')
+            else:
+                self.report({'INFO'}, f'LOD3 does not exist, skipping')
+
+        if lods:
+            with stage("import_lods") as profile:
                 converter.Export(
                     filename=filepath,
-                    lod='3',
+                    lods=lods,
                     parent_collection=col,
-                    useNormals=useNormals
+                    useNormals=useNormals,
+                    useInstancing=useInstancing
                 )
-                end = time.process_time()
-                self.report({'INFO'}, f'Time taken to Load LOD3: {end - start} seconds')
-            else:
-                self.report({'INFO'}, f'LOD3 does not exist, skipping')
+            self.report({'INFO'}, f'Time taken to Load LOD{", LOD".join(lods)}: {profile["wall"]:.2f} seconds')
     except Exception as e:
         self.report({'ERROR'}, str(e))
+    finally:
+        converter.Close()
 
     return {'FINISHED'}
 
 
 PRIMITIVEPATH = '/Primitives/'
 GEOMETRIEPATH = PRIMITIVEPATH + 'LOD0/'
+CACHE_DIRNAME = 'lutb_cache'
+GEOMETRY_CACHE_VERSION = 1
+DB_MANIFEST_VERSION = 1
+DB_EXTENSIONS = ('.g', '.g1', '.g2', '.g3', '.g4', '.xml')
 
 
 class Matrix3D:
@@ -302,6 +296,33 @@ class Matrix3D:
             self.n14 * other.n41 + self.n24 * other.n42 + self.n34 * other.n43 + self.n44 * other.n44
         )
 
+    def toArray(self):
+        return np.array((
+            (self.n11, self.n12, self.n13, self.n14),
+            (self.n21, self.n22, self.n23, self.n24),
+            (self.n31, self.n32, self.n33, self.n34),
+            (self.n41, self.n42, self.n43, self.n44)
+        ))
+
+
+def transformBones(positions, normals, bonemap, matrices):
+    # Batched counterpart of Point3D.transform / Point3D.transformW: every vertex is
+    # transformed by the matrix of the bone it is mapped to, vertices mapped to bones
+    # outside of matrices are left untouched.
+    if not matrices:
+        return positions, normals
+
+    stack = np.stack([matrix.toArray() for matrix in matrices])
+    bound = bonemap < len(matrices)
+    rotations = stack[bonemap[bound], :3, :3]
+    translations = stack[bonemap[bound], 3, :3]
+
+    positions = positions.copy()
+    normals = normals.copy()
+    positions[bound] = np.einsum("ni,nij->nj", positions[bound], rotations) + translations
+    normals[bound] = np.einsum("ni,nij->nj", normals[bound], rotations)
+    return positions, normals
+
 
 class Point3D:
     def __init__(self, x=0, y=0, z=0):
@@ -335,79 +356,37 @@ class Point3D:
         return Point3D(x=self.x, y=self.y, z=self.z)
 
 
-class Point2D:
-    def __init__(self, x=0, y=0):
-        self.x = x
-        self.y = y
-
-    def __str__(self):
-        return '[{0},{1}]'.format(self.x, self.y * -1)
-
-    def string(self, prefix="t"):
-        return '{0} {1:f} {2:f}\n'.format(prefix, self.x, self.y * -1)
-
-    def copy(self):
-        return Point2D(x=self.x, y=self.y)
-
-
-class Face:
-    def __init__(self, a=0, b=0, c=0):
-        self.a = a
-        self.b = b
-        self.c = c
-
-    def string(self, prefix="f", indexOffset=0, textureoffset=0):
-        if textureoffset == 0:
-            return prefix + ' {0}//{0} {1}//{1} {2}//{2}\n'.format(
-                self.a + indexOffset,
-                self.b + indexOffset,
-                self.c + indexOffset
-            )
-        else:
-            return prefix + ' {0}/{3}/{0} {1}/{4}/{1} {2}/{5}/{2}\n'.format(
-                self.a + indexOffset,
-                self.b + indexOffset,
-                self.c + indexOffset,
-                self.a + textureoffset,
-                self.b + textureoffset,
-                self.c + textureoffset
-            )
-
-    def __str__(self):
-        return '[{0},{1},{2}]'.format(self.a, self.b, self.c)
-
-
 class Group:
     def __init__(self, node):
-        self.partRefs = node.getAttribute('partRefs').split(',')
+        self.partRefs = node.get('partRefs', '').split(',')
 
 
 class Bone:
     def __init__(self, node):
-        self.refID = node.getAttribute('refID')
-        if node.hasAttribute('transformation'):
-            (a, b, c, d, e, f, g, h, i, x, y, z) = map(float, node.getAttribute('transformation').split(','))
+        self.refID = node.get('refID')
+        if 'transformation' in node.attrib:
+            (a, b, c, d, e, f, g, h, i, x, y, z) = map(float, node.get('transformation').split(','))
             self.matrix = Matrix3D(
                 n11=a, n12=b, n13=c, n14=0,
                 n21=d, n22=e, n23=f, n24=0,
                 n31=g, n32=h, n33=i, n34=0,
                 n41=x, n42=y, n43=z, n44=1
             )
-        elif node.hasAttribute('angle'):
+        elif 'angle' in node.attrib:
             # raise Exception("Cannot Properly import Old LDD Save formats")
             rotationMatrix = Matrix3D()
             rotationMatrix.rotate(
-                angle=float(node.getAttribute('angle')) * math.pi / 180.0,
+                angle=float(node.get('angle')) * math.pi / 180.0,
                 axis=Point3D(
-                    x=float(node.getAttribute('ax')),
-                    y=float(node.getAttribute('ay')),
-                    z=float(node.getAttribute('az'))
+                    x=float(node.get('ax')),
+                    y=float(node.get('ay')),
+                    z=float(node.get('az'))
                 )
             )
             p = Point3D(
-                x=float(node.getAttribute('tx')),
-                y=float(node.getAttribute('ty')),
-                z=float(node.getAttribute('tz'))
+                x=float(node.get('tx')),
+                y=float(node.get('ty')),
+                z=float(node.get('tz'))
             )
             p.transformW(rotationMatrix)
             rotationMatrix.n41 = p.x
@@ -423,19 +402,19 @@ class Part:
         self.isGrouped = False
         self.GroupIDX = 0
         self.Bones = []
-        self.refID = node.getAttribute('refID')
-        self.designID = node.getAttribute('designID')
-        if node.hasAttribute('materials'):
-            self.materials = list(map(str, node.getAttribute('materials').split(',')))
-            for childnode in node.childNodes:
-                if childnode.nodeName == 'Bone':
+        self.refID = node.get('refID')
+        self.designID = node.get('designID')
+        if 'materials' in node.attrib:
+            self.materials = list(map(str, node.get('materials').split(',')))
+            for childnode in node:
+                if childnode.tag == 'Bone':
                     self.Bones.append(Bone(node=childnode))
             for i, m in enumerate(self.materials):
                 if (m == '0'):
                     # self.materials[i] = lastm
                     self.materials[i] = self.materials[0]  # in case of 0 choose the 'base' material
-        elif node.hasAttribute('materialID'):
-            self.materials = [str(node.getAttribute('materialID'))]
+        elif 'materialID' in node.attrib:
+            self.materials = [str(node.get('materialID'))]
             self.Bones.append(Bone(node=node))
         else:
             raise Exception("Not valid Part")
@@ -443,11 +422,11 @@ class Part:
 
 class Brick:
     def __init__(self, node):
-        self.refID = node.getAttribute('refID')
-        self.designID = node.getAttribute('designID')
+        self.refID = node.get('refID')
+        self.designID = node.get('designID')
         self.Parts = []
-        for childnode in node.childNodes:
-            if childnode.nodeName == 'Part':
+        for childnode in node:
+            if childnode.tag == 'Part':
                 self.Parts.append(Part(node=childnode))
 
 
@@ -459,64 +438,70 @@ class Scene:
         self.Name = "Unknown"
 
         if file.endswith('.lxfml'):
-            with open(file, "rb") as file:
-                data = file.read()
+            with open(file, "rb") as source:
+                self.parse(source)
         elif file.endswith('.lxf'):
-            zf = zipfile.ZipFile(file, 'r')
-            data = zf.read('IMAGE100.LXFML')
+            with zipfile.ZipFile(file, 'r') as zf, zf.open('IMAGE100.LXFML') as source:
+                self.parse(source)
         else:
             return
 
-        xml = minidom.parseString(data)
-        try:
-            self.Name = xml.firstChild.getAttribute('name')
-        except Exception as e:
-            print(f"ERROR: {e}")
-        for node in xml.firstChild.childNodes:
-            if node.nodeName == 'Meta':
-                for childnode in node.childNodes:
-                    if childnode.nodeName == 'BrickSet':
-                        try:
-                            self.Version = str(childnode.getAttribute('version'))
-                        except Exception as e:
-                            print(f"ERROR: {e}")
-            elif node.nodeName == 'Bricks':
-                for childnode in node.childNodes:
-                    if childnode.nodeName == 'Brick':
-                        self.Bricks.append(Brick(node=childnode))
-            elif node.nodeName == 'Scene':
-                for childnode in node.childNodes:
-                    if childnode.nodeName == 'Model':
-                        for childnode2 in childnode.childNodes:
-                            if childnode2.nodeName == 'Group':
-                                self.Bricks.append(Brick(node=childnode2))
-            elif node.nodeName == 'GroupSystems':
-                for childnode in node.childNodes:
-                    if childnode.nodeName == 'GroupSystem':
-                        for childnode in childnode.childNodes:
-                            if childnode.nodeName == 'Group':
-                                self.Groups.append(Group(node=childnode))
-
-        for i in range(len(self.Groups)):
-            for brick in self.Bricks:
-                for part in brick.Parts:
-                    if part.refID in self.Groups[i].partRefs:
-                        part.isGrouped = True
-                        part.GroupIDX = i
+        groupIndex = {}
+        for i, group in enumerate(self.Groups):
+            for partRef in group.partRefs:
+                groupIndex[partRef] = i
+
+        for brick in self.Bricks:
+            for part in brick.Parts:
+                if (i := groupIndex.get(part.refID)) is not None:
+                    part.isGrouped = True
+                    part.GroupIDX = i
+
+    def parse(self, source):
+        # Bricks and groups are built as soon as their element is complete and then dropped
+        # from the tree, so memory use doesn't grow with the size of the LXFML.
+        path = []
+        for event, node in ElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if not path:
+                    self.Name = node.get('name', '')
+                path.append(node)
+                continue
+
+            path.pop()
+            ancestors = [ancestor.tag for ancestor in path[1:]]
+            consumed = len(path) == 1
+
+            if node.tag == 'BrickSet' and ancestors == ['Meta']:
+                self.Version = str(node.get('version', ''))
+            elif node.tag == 'Brick' and ancestors == ['Bricks']:
+                self.Bricks.append(Brick(node=node))
+                consumed = True
+            elif node.tag == 'Group' and ancestors == ['Scene', 'Model']:
+                self.Bricks.append(Brick(node=node))
+                consumed = True
+            elif node.tag == 'Group' and ancestors == ['GroupSystems', 'GroupSystem']:
+                self.Groups.append(Group(node=node))
+                consumed = True
+
+            if consumed:
+                node.clear()
+                path[-1].remove(node)
 
 
 class GeometryReader:
-    def __init__(self, data):
+    def __init__(self, data=b''):
         self.offset = 0
         self.data = data
-        self.positions = []
-        self.normals = []
-        self.textures = []
-        self.faces = []
-        self.bonemap = {}
+        self.positions = np.empty((0, 3))
+        self.normals = np.empty((0, 3))
+        self.textures = np.empty((0, 2))
+        self.faces = np.empty((0, 3), dtype=np.uint32)
+        self.bonemap = np.empty(0, dtype=np.uint32)
+        self.valueCount = 0
+        self.indexCount = 0
+        self.faceCount = 0
         self.texCount = 0
-        self.outpositions = []
-        self.outnormals = []
 
         if self.readInt() == 1111961649:
             self.valueCount = self.readInt()
@@ -524,23 +509,14 @@ class GeometryReader:
             self.faceCount = int(self.indexCount / 3)
             options = self.readInt()
 
-            for i in range(0, self.valueCount):
-                self.positions.append(
-                    Point3D(x=self.readFloat(), y=self.readFloat(), z=self.readFloat())
-                )
-
-            for i in range(0, self.valueCount):
-                self.normals.append(
-                    Point3D(x=self.readFloat(), y=self.readFloat(), z=self.readFloat())
-                )
+            self.positions = self.readArray('<f4', self.valueCount * 3).reshape(-1, 3).astype(np.float64)
+            self.normals = self.readArray('<f4', self.valueCount * 3).reshape(-1, 3).astype(np.float64)
 
             if (options & 3) == 3:
                 self.texCount = self.valueCount
-                for i in range(0, self.valueCount):
-                    self.textures.append(Point2D(x=self.readFloat(), y=self.readFloat()))
+                self.textures = self.readArray('<f4', self.valueCount * 2).reshape(-1, 2).astype(np.float64)
 
-            for i in range(0, self.faceCount):
-                self.faces.append(Face(a=self.readInt(), b=self.readInt(), c=self.readInt()))
+            self.faces = self.readArray('<u4', self.faceCount * 3).reshape(-1, 3)
 
             if (options & 48) == 48:
                 num = self.readInt()
@@ -549,78 +525,104 @@ class GeometryReader:
                 self.offset += (3 * num * 4) + (self.indexCount * 4)
 
             bonelength = self.readInt()
-            self.bonemap = [0] * self.valueCount
+            self.bonemap = np.zeros(self.valueCount, dtype=np.uint32)
 
             if (bonelength > self.valueCount) or (bonelength > self.faceCount):
                 datastart = self.offset
                 self.offset += bonelength
-                for i in range(0, self.valueCount):
-                    boneoffset = self.readInt() + 4
-                    self.bonemap[i] = self.read_Int(datastart + boneoffset)
-
-    def read_Int(self, _offset):
-        if sys.version_info < (3, 0):
-            return int(struct.unpack_from('i', self.data, _offset)[0])
-        else:
-            return int.from_bytes(self.data[_offset:_offset + 4], byteorder='little')
-
-    def readInt(self):
-        if sys.version_info < (3, 0):
-            ret = int(struct.unpack_from('i', self.data, self.offset)[0])
-        else:
-            ret = int.from_bytes(self.data[self.offset:self.offset + 4], byteorder='little')
-        self.offset += 4
+                # every vertex stores a byte offset into the bone table, the bone index
+                # itself sits 4 bytes after that (offsets aren't necessarily aligned)
+                boneoffsets = self.readArray('<u4', self.valueCount).astype(np.int64) + datastart + 4
+                raw = np.frombuffer(self.data, dtype=np.uint8)
+                self.bonemap = raw[boneoffsets[:, None] + np.arange(4)].view('<u4').ravel()
+
+    @classmethod
+    def fromArrays(cls, positions, normals, textures, faces, bonemap):
+        reader = cls()
+        reader.positions = positions
+        reader.normals = normals
+        reader.textures = textures
+        reader.faces = faces
+        reader.bonemap = bonemap
+        reader.valueCount = len(positions)
+        reader.indexCount = faces.size
+        reader.faceCount = len(faces)
+        reader.texCount = len(textures)
+        return reader
+
+    def readArray(self, dtype, count):
+        ret = np.frombuffer(self.data, dtype=dtype, count=count, offset=self.offset)
+        self.offset += ret.nbytes
         return ret
 
-    def readFloat(self):
-        ret = float(struct.unpack_from('f', self.data, self.offset)[0])
+    def readInt(self):
+        ret = int.from_bytes(self.data[self.offset:self.offset + 4], byteorder='little')
         self.offset += 4
         return ret
 
 
 class Geometry:
-    def __init__(self, designID, database, lod):
+    def __init__(self, designID, database, lod, cache=None):
         self.designID = designID
         self.Parts = {}
+        self.Partname = ''
         self.maxGeoBounding = -1
 
-        if lod is None:
-            geompath = GEOMETRIEPATH
-        else:
-            geompath = os.path.join(database.location, 'brickprimitives', 'lod' + lod + '/')
+        geometryFiles = database.geometryFiles(designID, lod)
+        primitiveFile = database.primitiveFile(designID)
+        sources = geometryFiles + [primitiveFile]
 
-        GeometryLocation = os.path.normpath('{0}{1}{2}'.format(geompath, designID, '.g'))
-        GeometryCount = 0
-        while str(GeometryLocation) in database.filelist:
-            self.Parts[GeometryCount] = GeometryReader(data=database.filelist[GeometryLocation].read())
-            GeometryCount += 1
-            GeometryLocation = os.path.normpath(f'{geompath}{designID}.g{GeometryCount}')
+        if cache is not None and cache.load(self, lod, sources):
+            return
 
-        primitive = Primitive(data=database.filelist[os.path.normpath(PRIMITIVEPATH + designID + '.xml')].read())
-        self.Partname = primitive.Designname
-        try:
-            geoBoundingList = [
-                abs(float(primitive.Bounding['minX']) - float(primitive.Bounding['maxX'])),
-                abs(float(primitive.Bounding['minY']) - float(primitive.Bounding['maxY'])),
-                abs(float(primitive.Bounding['minZ']) - float(primitive.Bounding['maxZ']))
-            ]
-            geoBoundingList.sort()
-            self.maxGeoBounding = geoBoundingList[-1]
-        except KeyError as e:
-            print(f'\nBounding errror in part {designID}: {e}\n')
+        for GeometryCount, geometryFile in enumerate(geometryFiles):
+            self.Parts[GeometryCount] = GeometryReader(data=geometryFile.read())
+
+        primitive = getPrimitiveInfo(primitiveFile)
+        self.Partname = primitive.designName
+        if primitive.maxBounding is None:
+            print(f'\nBounding errror in part {designID}: no AABB\n')
+        else:
+            self.maxGeoBounding = primitive.maxBounding
 
         # preflex
         for part in self.Parts:
-            # transform
-            for i, b in enumerate(primitive.Bones):
-                # positions
-                for j, p in enumerate(self.Parts[part].positions):
-                    if (self.Parts[part].bonemap[j] == i):
-                        self.Parts[part].positions[j].transform(b.matrix)
-                # normals
-                for k, n in enumerate(self.Parts[part].normals):
-                    if (self.Parts[part].bonemap[k] == i):
-                        self.Parts[part].normals[k].transformW(b.matrix)
+            reader = self.Parts[part]
+            reader.positions, reader.normals = transformBones(
+                reader.positions,
+                reader.normals,
+                reader.bonemap,
+                primitive.boneMatrices
+            )
+
+        if cache is not None:
+            cache.save(self, lod, sources)
+
+    # concatenate all parts into brick sized buffers
+    def combine(self):
+        valueCount = self.valuecount()
+        faceCount = self.facecount()
+        self.positions = np.empty((valueCount, 3))
+        self.normals = np.empty((valueCount, 3))
+        self.uvs = np.zeros((valueCount, 2)) if self.texcount() else None
+        self.faces = np.empty((faceCount, 3), dtype=np.uint32)
+        self.faceParts = np.empty(faceCount, dtype=np.int32)
+        self.bonemap = np.empty(valueCount, dtype=np.uint32)
+
+        valueOffset = 0
+        faceOffset = 0
+        for part, reader in self.Parts.items():
+            values = slice(valueOffset, valueOffset + reader.valueCount)
+            faces = slice(faceOffset, faceOffset + reader.faceCount)
+            self.positions[values] = reader.positions
+            self.normals[values] = reader.normals
+            if reader.texCount:
+                self.uvs[values] = reader.textures * (1, -1)
+            self.faces[faces] = reader.faces + valueOffset
+            self.faceParts[faces] = part
+            self.bonemap[values] = reader.bonemap
+            valueOffset += reader.valueCount
+            faceOffset += reader.faceCount
 
     def valuecount(self):
         count = 0
@@ -641,6 +643,42 @@ class Geometry:
         return count
 
 
+def buildMesh(name, positions, normals, faces, uvs, materialIndices):
+    mesh = bpy.data.meshes.new(name)
+    loopCount = faces.size
+
+    mesh.vertices.add(len(positions))
+    mesh.vertices.foreach_set("co", positions.astype(np.float32).ravel())
+
+    mesh.loops.add(loopCount)
+    mesh.loops.foreach_set("vertex_index", faces.astype(np.int32).ravel())
+
+    mesh.polygons.add(len(faces))
+    mesh.polygons.foreach_set("loop_start", np.arange(0, loopCount, 3, dtype=np.int32))
+    mesh.polygons.foreach_set("loop_total", np.full(len(faces), 3, dtype=np.int32))
+    mesh.polygons.foreach_set("use_smooth", np.ones(len(faces), dtype=bool))
+    mesh.polygons.foreach_set("material_index", materialIndices.astype(np.int32))
+
+    mesh.update(calc_edges=True)
+
+    # loops are written in face order, so the face array is the loop -> vertex map
+    loopVertices = faces.ravel()
+
+    if uvs is not None:
+        uv_layer = mesh.uv_layers.new(do_init=False)
+        uv_layer.data.foreach_set("uv", uvs[loopVertices].astype(np.float32).ravel())
+
+    if normals is not None:
+        loopNormals = normals[loopVertices].astype(np.float32)
+        lengths = np.linalg.norm(loopNormals, axis=1, keepdims=True)
+        np.divide(loopNormals, lengths, out=loopNormals, where=lengths > 0)
+
+        mesh.use_auto_smooth = True
+        mesh.normals_split_custom_set(loopNormals)
+
+    return mesh
+
+
 class Bone2:
     def __init__(self, boneId=0, angle=0, ax=0, ay=0, az=0, tx=0, ty=0, tz=0):
         self.boneId = boneId
@@ -657,186 +695,69 @@ class Bone2:
         self.matrix = rotationMatrix
 
 
-class Field2D:
-    def __init__(self, type=0, width=0, height=0, angle=0, ax=0, ay=0, az=0, tx=0, ty=0, tz=0, field2DRawData='none'):
-        self.type = type
-        self.field2DRawData = field2DRawData
-        rotationMatrix = Matrix3D()
-        rotationMatrix.rotate(
-            angle=(-angle * math.pi / 180.0),
-            axis=Point3D(x=ax, y=ay, z=az)
-        )
-        p = Point3D(x=tx, y=ty, z=tz)
-        p.transformW(rotationMatrix)
-        rotationMatrix.n41 -= p.x
-        rotationMatrix.n42 -= p.y
-        rotationMatrix.n43 -= p.z
+def readAABB(node):
+    aabb = node.find('AABB')
+    if aabb is None:
+        return {}
+    return {key: aabb.get(key, '') for key in ('minX', 'minY', 'minZ', 'maxX', 'maxY', 'maxZ')}
 
-        self.matrix = rotationMatrix
-        self.custom2DField = []
-
-        # The height and width are always double the number of studs.
-        # The contained text is a 2D array that is always height + 1 and width + 1.
-        rows_count = height + 1
-        cols_count = width + 1
-        # creation looks reverse
-        # create an array of "cols_count" cols, for each of the "rows_count" rows
-        # all elements are initialized to 0
-        self.custom2DField = [[0 for j in range(cols_count)] for i in range(rows_count)]
-        custom2DFieldString = field2DRawData.replace('\r', '').replace('\n', '').replace(' ', '')
-        custom2DFieldArr = custom2DFieldString.strip().split(',')
-
-        k = 0
-        for i in range(rows_count):
-            for j in range(cols_count):
-                self.custom2DField[i][j] = custom2DFieldArr[k]
-                k += 1
 
-    def __str__(self):
-        return f'[type="{self.type}" transform="{self.matrix}" custom2DField="{self.custom2DField}"]'
+def readBone2(node):
+    return Bone2(
+        boneId=int(node.get('boneId')),
+        angle=float(node.get('angle')),
+        ax=float(node.get('ax')),
+        ay=float(node.get('ay')),
+        az=float(node.get('az')),
+        tx=float(node.get('tx')),
+        ty=float(node.get('ty')),
+        tz=float(node.get('tz'))
+    )
 
 
-class CollisionBox:
-    def __init__(self, sX=0, sY=0, sZ=0, angle=0, ax=0, ay=0, az=0, tx=0, ty=0, tz=0):
-        rotationMatrix = Matrix3D()
-        rotationMatrix.rotate(
-            angle=(-angle * math.pi / 180.0),
-            axis=Point3D(x=ax, y=ay, z=az)
-        )
-        p = Point3D(x=tx, y=ty, z=tz)
-        p.transformW(rotationMatrix)
-        rotationMatrix.n41 -= p.x
-        rotationMatrix.n42 -= p.y
-        rotationMatrix.n43 -= p.z
+# The part of a primitive the importer actually needs: design name, largest bounding box
+# extent and bone matrices. Collision boxes and connectivity fields are skipped entirely.
+class PrimitiveInfo:
+    __slots__ = ('designName', 'maxBounding', 'boneMatrices')
 
-        self.matrix = rotationMatrix
-        self.corner = Point3D(x=sX, y=sY, z=sZ)
-        self.positions = []
-
-        self.positions.append(Point3D(x=0, y=0, z=0))
-        self.positions.append(Point3D(x=sX, y=0, z=0))
-        self.positions.append(Point3D(x=0, y=sY, z=0))
-        self.positions.append(Point3D(x=sX, y=sY, z=0))
-        self.positions.append(Point3D(x=0, y=0, z=sZ))
-        self.positions.append(Point3D(x=0, y=sY, z=sZ))
-        self.positions.append(Point3D(x=sX, y=0, z=sZ))
-        self.positions.append(Point3D(x=sX, y=sY, z=sZ))
+    def __init__(self, data):
+        self.designName = ''
+        self.maxBounding = None
+        self.boneMatrices = []
+
+        for node in ElementTree.fromstring(data):
+            if node.tag == 'Flex':
+                self.boneMatrices = [readBone2(bone).matrix for bone in node.findall('Bone')]
+            elif node.tag == 'Annotations':
+                for childnode in node:
+                    if childnode.tag == 'Annotation' and 'designname' in childnode.attrib:
+                        self.designName = childnode.get('designname')
+            elif node.tag == 'Bounding':
+                bounding = readAABB(node)
+                if bounding:
+                    self.maxBounding = max(
+                        abs(float(bounding[f'min{axis}']) - float(bounding[f'max{axis}'])) for axis in 'XYZ'
+                    )
 
-    def __str__(self):
-        return f'[0,0,0] \
-            [{self.corner.x},0,0] \
-            [0,{self.corner.y},0] \
-            [{self.corner.x},{self.corner.y},0] \
-            [0,0,{self.corner.z}] \
-            [0,{self.corner.y},{self.corner.z}] \
-            [{self.corner.x},0,{2}] \
-            [{self.corner.x},{1},{2}]'
 
+# Parsed primitives are shared between LODs and between imports. Entries are keyed by the
+# file's path and stats, so an updated Brick DB is picked up without restarting Blender.
+primitiveInfoCache = {}
 
-class Primitive:
-    def __init__(self, data):
-        self.Designname = ''
-        self.Bones = []
-        self.Fields2D = []
-        self.CollisionBoxes = []
-        self.PhysicsAttributes = {}
-        self.Bounding = {}
-        self.GeometryBounding = {}
-
-        xml = minidom.parseString(data)
-        root = xml.documentElement
-
-        for node in root.childNodes:
-            if node.__class__.__name__.lower() == 'comment':
-                self.comment = node[0].nodeValue
-            if node.nodeName == 'Flex':
-                for node in node.childNodes:
-                    if node.nodeName == 'Bone':
-                        self.Bones.append(
-                            Bone2(
-                                boneId=int(node.getAttribute('boneId')),
-                                angle=float(node.getAttribute('angle')),
-                                ax=float(node.getAttribute('ax')),
-                                ay=float(node.getAttribute('ay')),
-                                az=float(node.getAttribute('az')),
-                                tx=float(node.getAttribute('tx')),
-                                ty=float(node.getAttribute('ty')),
-                                tz=float(node.getAttribute('tz'))
-                            )
-                        )
-            elif node.nodeName == 'Annotations':
-                for childnode in node.childNodes:
-                    if childnode.nodeName == 'Annotation' and childnode.hasAttribute('designname'):
-                        self.Designname = childnode.getAttribute('designname')
-            elif node.nodeName == 'Collision':
-                for childnode in node.childNodes:
-                    if childnode.nodeName == 'Box':
-                        self.CollisionBoxes.append(
-                            CollisionBox(
-                                sX=float(childnode.getAttribute('sX')),
-                                sY=float(childnode.getAttribute('sY')),
-                                sZ=float(childnode.getAttribute('sZ')),
-                                angle=float(childnode.getAttribute('angle')),
-                                ax=float(childnode.getAttribute('ax')),
-                                ay=float(childnode.getAttribute('ay')),
-                                az=float(childnode.getAttribute('az')),
-                                tx=float(childnode.getAttribute('tx')),
-                                ty=float(childnode.getAttribute('ty')),
-                                tz=float(childnode.getAttribute('tz'))
-                            )
-                        )
-            elif node.nodeName == 'PhysicsAttributes':
-                self.PhysicsAttributes = {
-                    "inertiaTensor": node.getAttribute('inertiaTensor'),
-                    "centerOfMass": node.getAttribute('centerOfMass'),
-                    "mass": node.getAttribute('mass'),
-                    "frictionType": node.getAttribute('frictionType')
-                }
-            elif node.nodeName == 'Bounding':
-                for childnode in node.childNodes:
-                    if childnode.nodeName == 'AABB':
-                        self.Bounding = {
-                            "minX": childnode.getAttribute('minX'),
-                            "minY": childnode.getAttribute('minY'),
-                            "minZ": childnode.getAttribute('minZ'),
-                            "maxX": childnode.getAttribute('maxX'),
-                            "maxY": childnode.getAttribute('maxY'),
-                            "maxZ": childnode.getAttribute('maxZ')
-                        }
-            elif node.nodeName == 'GeometryBounding':
-                for childnode in node.childNodes:
-                    if childnode.nodeName == 'AABB':
-                        self.GeometryBounding = {
-                            "minX": childnode.getAttribute('minX'),
-                            "minY": childnode.getAttribute('minY'),
-                            "minZ": childnode.getAttribute('minZ'),
-                            "maxX": childnode.getAttribute('maxX'),
-                            "maxY": childnode.getAttribute('maxY'),
-                            "maxZ": childnode.getAttribute('maxZ')
-                        }
-            elif node.nodeName == 'Connectivity':
-                for childnode in node.childNodes:
-                    if childnode.nodeName == 'Custom2DField':
-                        self.Fields2D.append(
-                            Field2D(
-                                type=int(childnode.getAttribute('type')),
-                                width=int(childnode.getAttribute('width')),
-                                height=int(childnode.getAttribute('height')),
-                                angle=float(childnode.getAttribute('angle')),
-                                ax=float(childnode.getAttribute('ax')),
-                                ay=float(childnode.getAttribute('ay')),
-                                az=float(childnode.getAttribute('az')),
-                                tx=float(childnode.getAttribute('tx')),
-                                ty=float(childnode.getAttribute('ty')),
-                                tz=float(childnode.getAttribute('tz')),
-                                field2DRawData=str(childnode.firstChild.data)
-                            )
-                        )
+
+def getPrimitiveInfo(primitiveFile):
+    key = (primitiveFile.name, primitiveFile.stat())
+    info = primitiveInfoCache.get(key)
+    if info is None:
+        info = PrimitiveInfo(data=primitiveFile.read())
+        primitiveInfoCache[key] = info
+    return info
 
 
 class Materials:
     def __init__(self):
         self.MaterialsRi = {}
+        self.BlenderMaterials = {}
         self.loadColors(MATERIALS_OPAQUE, "shinyPlastic")
         self.loadColors(MATERIALS_TRANSPARENT, "Transparent")
         self.loadColors(MATERIALS_METALLIC, "Metallic")
@@ -861,6 +782,13 @@ class Materials:
             print(f"Material {mid} does not exist")
             return self.MaterialsRi["26"]
 
+    # Each color's Blender material is created once and shared by all bricks and LODs of an import
+    def getBlenderMaterial(self, materialRi):
+        material = self.BlenderMaterials.get(materialRi.materialId)
+        if material is None:
+            material = self.BlenderMaterials[materialRi.materialId] = materialRi.string(None)
+        return material
+
 
 class MaterialRi:
     def __init__(self, materialId, r, g, b, a, materialType):
@@ -895,10 +823,17 @@ class DBFolderFile:
         finally:
             reader.close()
 
+    def stat(self):
+        stat = os.stat(self.handle)
+        return (stat.st_mtime_ns, stat.st_size)
+
 
 class DBFolderReader:
     def __init__(self, folder):
         self.filelist = {}
+        self.geometries = {}
+        self.primitives = {}
+        self.lods = set()
         self.initok = False
         self.location = folder
 
@@ -919,247 +854,442 @@ class DBFolderReader:
     def fileexist(self, filename):
         return filename in self.filelist
 
-    def parse(self):
-        if not os.path.exists(os.path.join(self.location, "Assemblies")) and \
-                os.path.exists(os.path.join(self.location, "brickdb.zip")):
-            print("Found brickdb.zip without uzipped files")
-            with zipfile.ZipFile(os.path.join(self.location, "brickdb.zip"), 'r') as zip_ref:
-                print("Extracting brickdb.zip")
-                zip_ref.extractall(self.location)
-        extentions = ('.g', '.g1', '.g2', '.g3', '.g4', '.xml')
-        for path, subdirs, files in os.walk(self.location):
-            files = filter(lambda file: file.endswith(extentions), files)
-            for name in files:
-                entryName = os.path.join(path, name)
-                self.filelist[entryName] = DBFolderFile(name=entryName, handle=entryName)
-
-
-class Converter:
+    def hasLOD(self, lod):
+        return lod in self.lods
 
-    def LoadDBFolder(self, dbfolderlocation):
-        self.database = DBFolderReader(folder=dbfolderlocation)
+    def geometryFiles(self, designID, lod):
+        # .g, .g1, .g2, ... are only used up to the first missing index
+        files = []
+        entries = self.geometries.get((lod, designID), {})
+        while len(files) in entries:
+            files.append(entries[len(files)])
+        return files
 
-        if self.database.initok:
-            self.allMaterials = Materials()
+    def primitiveFile(self, designID):
+        return self.primitives[designID]
 
-    def LoadScene(self, filename):
-        if self.database.initok:
-            self.scene = Scene(file=filename)
+    def close(self):
+        pass
 
-    def Export(self, filename, lod=None, parent_collection=None, useNormals=True):
-        invert = Matrix3D()
-        usedmaterials = []
-        geometriecache = {}
-        current = 0
-        currentpart = 0
+    def parse(self):
+        manifest = self.loadManifest()
+        if manifest is None:
+            manifest = self.buildManifest()
+            self.saveManifest(manifest)
 
-        miny = 1000
+        for dirparts, mtime, files in manifest['dirs']:
+            path = os.path.join(self.location, *dirparts)
+            for name in files:
+                entryName = os.path.join(path, name)
+                self.addFile(dirparts, name, DBFolderFile(name=entryName, handle=entryName))
+            if dirparts and dirparts[-1].startswith('lod'):
+                self.lods.add(dirparts[-1][3:])
+
+    def addFile(self, dirparts, name, file):
+        self.filelist[file.name] = file
+
+        designID, ext = os.path.splitext(name)
+        if ext == '.xml' and dirparts == ['Primitives']:
+            self.primitives[designID] = file
+        elif ext.startswith('.g'):
+            if dirparts == ['Primitives', 'LOD0']:
+                lod = None
+            elif len(dirparts) == 2 and dirparts[0] == 'brickprimitives' and dirparts[1].startswith('lod'):
+                lod = dirparts[1][3:]
+            else:
+                return
+            index = int(ext[2:]) if len(ext) > 2 else 0
+            self.geometries.setdefault((lod, designID), {})[index] = file
+
+    # The manifest lists every Brick DB file the importer cares about together with the mtime
+    # of its directory. Adding or removing files changes that mtime, which is all we need to
+    # check to know whether the manifest is still up to date.
+    def manifestPath(self):
+        return os.path.join(self.location, CACHE_DIRNAME, 'manifest.json')
+
+    def buildManifest(self):
+        # creating the cache folder changes the mtime of the DB folder, so it has to exist
+        # before that mtime is recorded
+        try:
+            os.makedirs(os.path.dirname(self.manifestPath()), exist_ok=True)
+        except OSError:
+            pass
 
-        global_matrix = axis_conversion(from_forward='-Z', from_up='Y', to_forward='Y', to_up='Z').to_4x4()
-        if lod is not None:
-            col = bpy.data.collections.new(self.scene.Name + '_LOD_' + lod)
-        else:
-            col = bpy.data.collections.new(self.scene.Name)
+        dirs = []
+        for path, subdirs, files in os.walk(self.location):
+            if path == self.location and CACHE_DIRNAME in subdirs:
+                subdirs.remove(CACHE_DIRNAME)
+            dirparts = os.path.relpath(path, self.location).split(os.sep) if path != self.location else []
+            files = [file for file in files if file.endswith(DB_EXTENSIONS)]
+            dirs.append((dirparts, os.stat(path).st_mtime_ns, files))
+        return {'version': DB_MANIFEST_VERSION, 'dirs': dirs}
+
+    def loadManifest(self):
+        try:
+            with open(self.manifestPath(), 'r') as file:
+                manifest = json.load(file)
+            if manifest.get('version') != DB_MANIFEST_VERSION:
+                return None
+            for dirparts, mtime, files in manifest['dirs']:
+                if os.stat(os.path.join(self.location, *dirparts)).st_mtime_ns != mtime:
+                    return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return manifest
+
+    def saveManifest(self, manifest):
+        path = self.manifestPath()
+        temppath = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temppath, 'w') as file:
+                json.dump(manifest, file)
+            os.replace(temppath, path)
+        except OSError as e:
+            print(f'WARNING: Failed to write Brick DB manifest: {e}')
+            if os.path.exists(temppath):
+                os.remove(temppath)
+
+
+class DBZipFile:
+    def __init__(self, name, archive, member, mapped=None):
+        self.archive = archive
+        self.mapped = mapped
+        self.member = member
+        self.name = name
 
-        if parent_collection:
-            parent_collection.children.link(col)
-        else:
-            bpy.context.scene.collection.children.link(col)
+    def read(self):
+        if self.mapped is None or self.member.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return self.archive.read(self.member)
+
+        # slice the member straight out of the mapped archive, skipping the local file header
+        offset = self.member.header_offset
+        nameLength, extraLength = struct.unpack_from('<HH', self.mapped, offset + 26)
+        start = offset + 30 + nameLength + extraLength
+        data = self.mapped[start:start + self.member.compress_size]
+        if self.member.compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -zlib.MAX_WBITS)
+        return data
+
+    def stat(self):
+        return (self.member.CRC, self.member.file_size)
+
+
+# Serves the contents of LU's brickdb.zip straight from the archive instead of extracting it.
+# Loose files next to it (like res/brickprimitives/) are still picked up from disk.
+class DBZipReader(DBFolderReader):
+    def __init__(self, folder, useMmap=True):
+        self.zipLocation = os.path.join(folder, "brickdb.zip")
+        self.useMmap = useMmap
+        self.file = None
+        self.mapped = None
+        self.archive = None
+        super().__init__(folder)
+
+    @staticmethod
+    def isZipDB(folder):
+        return not os.path.exists(os.path.join(folder, "Assemblies")) and \
+            os.path.exists(os.path.join(folder, "brickdb.zip"))
+
+    def close(self):
+        if self.archive:
+            self.archive.close()
+        if self.mapped:
+            self.mapped.close()
+        if self.file:
+            self.file.close()
+        self.archive = self.mapped = self.file = None
 
-        for bri in self.scene.Bricks:
-            current += 1
+    def parse(self):
+        super().parse()
+
+        print("Found brickdb.zip without uzipped files, reading it directly")
+        self.file = open(self.zipLocation, "rb")
+        if self.useMmap:
+            self.mapped = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.archive = zipfile.ZipFile(self.file, 'r')
+
+        for member in self.archive.infolist():
+            if member.is_dir() or not member.filename.endswith(DB_EXTENSIONS):
+                continue
+            *dirparts, name = member.filename.split('/')
+            entryName = os.path.join(self.location, *dirparts, name)
+            self.addFile(dirparts, name, DBZipFile(name=entryName, archive=self.archive, member=member, mapped=self.mapped))
+            if dirparts and dirparts[-1].startswith('lod'):
+                self.lods.add(dirparts[-1][3:])
+
+
+# Preflexed brick geometry stored as .npz files inside the Brick DB folder. Entries are keyed
+# by designID and LOD and remember the stats of every file they were decoded from, so they
+# get rebuilt as soon as any of those files change.
+class GeometryCache:
+    def __init__(self, location):
+        self.location = os.path.join(location, CACHE_DIRNAME, 'geometry')
+        self.writable = True
+
+    def path(self, designID, lod):
+        lodname = 'lod' + lod if lod is not None else 'default'
+        return os.path.join(self.location, lodname, designID + '.npz')
+
+    def key(self, sources):
+        return np.array([(GEOMETRY_CACHE_VERSION, 0)] + [source.stat() for source in sources], dtype=np.int64)
+
+    def load(self, geometry, lod, sources):
+        path = self.path(geometry.designID, lod)
+        if not os.path.isfile(path):
+            return False
 
-            for pa in bri.Parts:
-                currentpart += 1
-                try:
-                    if pa.designID not in geometriecache:
-                        geo = Geometry(designID=pa.designID, database=self.database, lod=lod)
-                        geometriecache[pa.designID] = geo
-                    else:
-                        geo = geometriecache[pa.designID]
-                except Exception:
-                    print(f'WARNING: Missing geo for {pa.designID}')
-                    continue
-
-                # Read out 1st Bone matrix values
-                ind = 0
-                n11 = pa.Bones[ind].matrix.n11
-                n12 = pa.Bones[ind].matrix.n12
-                n13 = pa.Bones[ind].matrix.n13
-                n14 = pa.Bones[ind].matrix.n14
-                n21 = pa.Bones[ind].matrix.n21
-                n22 = pa.Bones[ind].matrix.n22
-                n23 = pa.Bones[ind].matrix.n23
-                n24 = pa.Bones[ind].matrix.n24
-                n31 = pa.Bones[ind].matrix.n31
-                n32 = pa.Bones[ind].matrix.n32
-                n33 = pa.Bones[ind].matrix.n33
-                n34 = pa.Bones[ind].matrix.n34
-                n41 = pa.Bones[ind].matrix.n41
-                n42 = pa.Bones[ind].matrix.n42
-                n43 = pa.Bones[ind].matrix.n43
-                n44 = pa.Bones[ind].matrix.n44
-
-                # Only parts with more then 1 bone are flex parts and for these we need to undo the transformation later
-                flexflag = 1
-                uniqueId = str(uuid.uuid4().hex)
-                material_string = '_' + '_'.join(pa.materials)
-                written_obj = geo.designID + material_string
-                brick_name = f"brick_{currentpart}_{written_obj}"
-
-                if (len(pa.Bones) > flexflag):
-                    # Flex parts are "unique". Ensure they get a unique filename
-                    written_obj = written_obj + "_" + uniqueId
-                    part_matrix = global_matrix
-                else:
-                    # Flex parts don't need to be moved, but non-flex parts need
-                    transform_matrix = mathutils.Matrix(
-                        (
-                            (n11, n21, n31, n41),
-                            (n12, n22, n32, n42),
-                            (n13, n23, n33, n43),
-                            (n14, n24, n34, n44)
-                        )
+        try:
+            with np.load(path) as data:
+                key = self.key(sources)
+                if data['key'].shape != key.shape or not np.array_equal(data['key'], key):
+                    return False
+
+                for part in range(int(data['parts'])):
+                    geometry.Parts[part] = GeometryReader.fromArrays(
+                        positions=data[f'{part}_positions'].astype(np.float64),
+                        normals=data[f'{part}_normals'].astype(np.float64),
+                        textures=data[f'{part}_textures'].astype(np.float64),
+                        faces=data[f'{part}_faces'],
+                        bonemap=data[f'{part}_bonemap']
                     )
+                geometry.Partname = str(data['name'])
+                geometry.maxGeoBounding = float(data['bounding'])
+        except Exception as e:
+            print(f'WARNING: Ignoring broken geometry cache entry {path}: {e}')
+            geometry.Parts = {}
+            return False
 
-                    # Random Scale for brick seams
-                    scalefact = (geo.maxGeoBounding - 0.000 * random.uniform(0.0, 1.000)) / geo.maxGeoBounding
+        return True
 
-                    scale_matrix = mathutils.Matrix.Scale(scalefact, 4)
-                    part_matrix = global_matrix @ transform_matrix @ scale_matrix
+    def save(self, geometry, lod, sources):
+        if not self.writable:
+            return
 
-                    # miny used for floor plane later
-                    if miny > float(n42):
-                        miny = n42
+        arrays = {
+            'key': self.key(sources),
+            'parts': len(geometry.Parts),
+            'name': geometry.Partname,
+            'bounding': geometry.maxGeoBounding,
+        }
+        for part, reader in geometry.Parts.items():
+            arrays[f'{part}_positions'] = reader.positions.astype(np.float32)
+            arrays[f'{part}_normals'] = reader.normals.astype(np.float32)
+            arrays[f'{part}_textures'] = reader.textures.astype(np.float32)
+            arrays[f'{part}_faces'] = reader.faces
+            arrays[f'{part}_bonemap'] = reader.bonemap
+
+        path = self.path(geometry.designID, lod)
+        temppath = f'{path}.{uuid.uuid4().hex}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temppath, 'wb') as file:
+                np.savez(file, **arrays)
+            os.replace(temppath, path)
+        except OSError as e:
+            print(f'WARNING: Failed to write geometry cache, disabling it for this import: {e}')
+            self.writable = False
+            if os.path.exists(temppath):
+                os.remove(temppath)
 
-                last_color = 0
-                geo_meshes = []
-                for part in geo.Parts:
 
-                    written_geo = str(geo.designID) + '_' + str(part)
+class Converter:
 
-                    geo.Parts[part].outpositions = [elem.copy() for elem in geo.Parts[part].positions]
-                    geo.Parts[part].outnormals = [elem.copy() for elem in geo.Parts[part].normals]
+    def LoadDBFolder(self, dbfolderlocation, useCache=True):
+        if DBZipReader.isZipDB(dbfolderlocation):
+            self.database = DBZipReader(folder=dbfolderlocation)
+        else:
+            self.database = DBFolderReader(folder=dbfolderlocation)
+        self.geometryCache = GeometryCache(location=dbfolderlocation) if useCache else None
 
-                    # translate / rotate only parts with more then 1 bone. This are flex parts
-                    if (len(pa.Bones) > flexflag):
+        if self.database.initok:
+            self.allMaterials = Materials()
 
-                        written_geo = written_geo + '_' + uniqueId
-                        for i, b in enumerate(pa.Bones):
-                            # positions
-                            for j, p in enumerate(geo.Parts[part].outpositions):
-                                if (geo.Parts[part].bonemap[j] == i):
-                                    p.transform(invert * b.matrix)
+    def Close(self):
+        if database := getattr(self, 'database', None):
+            database.close()
 
-                            # normals
-                            for k, n in enumerate(geo.Parts[part].outnormals):
-                                if (geo.Parts[part].bonemap[k] == i):
-                                    n.transformW(invert * b.matrix)
+    def LoadScene(self, filename):
+        if self.database.initok:
+            self.scene = Scene(file=filename)
 
-                    if "geo{0}".format(written_geo) not in geometriecache:
+    def LoadGeometries(self, lods):
+        # Decoding geometry doesn't touch bpy, so all unique designs are read up front on a
+        # thread pool. File and zip reads, decompression and the cache IO release the GIL.
+        designIDs = sorted({pa.designID for bri in self.scene.Bricks for pa in bri.Parts})
+        jobs = [(lod, designID) for lod in lods for designID in designIDs]
+
+        def load(job):
+            lod, designID = job
+            # designs without a primitive or geometry files end up as "Missing geo" warnings
+            if not self.database.geometryFiles(designID, lod):
+                return None
+            try:
+                geo = Geometry(designID=designID, database=self.database, lod=lod, cache=self.geometryCache)
+            except (KeyError, FileNotFoundError):
+                return None
+            except Exception as e:
+                print(f'ERROR: Failed to decode geometry for {designID} (LOD{lod or 0}): {type(e).__name__}: {e}')
+                raise
+            geo.combine()
+            return geo
+
+        with stage("geometry_decode", designs=len(designIDs), lods=len(lods)):
+            with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4)) as executor:
+                return dict(zip(jobs, executor.map(load, jobs)))
+
+    def Export(self, filename, lods=(None,), parent_collection=None, useNormals=True, useInstancing=False):
+        invert = Matrix3D()
+        geometriecache = self.LoadGeometries(lods)
+        with stage("mesh_build", parts=sum(len(bri.Parts) for bri in self.scene.Bricks)) as profile:
+            current = 0
+            currentpart = 0
 
-                        mesh = bpy.data.meshes.new("geo{0}".format(written_geo))
+            miny = 1000
 
-                        verts = []
-                        for point in geo.Parts[part].outpositions:
-                            single_vert = mathutils.Vector([point.x, point.y, point.z])
-                            verts.append(single_vert)
+            global_matrix = axis_conversion(from_forward='-Z', from_up='Y', to_forward='Y', to_up='Z').to_4x4()
 
-                        normals = []
-                        for point in geo.Parts[part].outnormals:
-                            single_norm = mathutils.Vector([point.x, point.y, point.z])
-                            normals.append(single_norm)
+            collections = {}
+            for lod in lods:
+                if lod is not None:
+                    col = bpy.data.collections.new(self.scene.Name + '_LOD_' + lod)
+                else:
+                    col = bpy.data.collections.new(self.scene.Name)
 
-                        faces = []
-                        for face in geo.Parts[part].faces:
-                            single_face = [face.a, face.b, face.c]
-                            faces.append(single_face)
+                if parent_collection:
+                    parent_collection.children.link(col)
+                else:
+                    bpy.context.scene.collection.children.link(col)
+                collections[lod] = col
+
+            # (lod, designID, material ids) -> mesh shared by all rigid parts looking exactly the same
+            instancedMeshes = {}
+
+            for bri in self.scene.Bricks:
+                current += 1
+
+                for pa in bri.Parts:
+                    currentpart += 1
+
+                    geos = {}
+                    for lod in lods:
+                        if (geo := geometriecache[(lod, pa.designID)]) is None:
+                            print(f'WARNING: Missing geo for {pa.designID}')
+                            continue
+                        geos[lod] = geo
+
+                    if not geos:
+                        continue
+
+                    # everything below up to the per LOD loop only depends on the part, not on the LOD
+                    anygeo = next(iter(geos.values()))
+
+                    # Read out 1st Bone matrix values
+                    ind = 0
+                    n11 = pa.Bones[ind].matrix.n11
+                    n12 = pa.Bones[ind].matrix.n12
+                    n13 = pa.Bones[ind].matrix.n13
+                    n14 = pa.Bones[ind].matrix.n14
+                    n21 = pa.Bones[ind].matrix.n21
+                    n22 = pa.Bones[ind].matrix.n22
+                    n23 = pa.Bones[ind].matrix.n23
+                    n24 = pa.Bones[ind].matrix.n24
+                    n31 = pa.Bones[ind].matrix.n31
+                    n32 = pa.Bones[ind].matrix.n32
+                    n33 = pa.Bones[ind].matrix.n33
+                    n34 = pa.Bones[ind].matrix.n34
+                    n41 = pa.Bones[ind].matrix.n41
+                    n42 = pa.Bones[ind].matrix.n42
+                    n43 = pa.Bones[ind].matrix.n43
+                    n44 = pa.Bones[ind].matrix.n44
+
+                    # Only parts with more then 1 bone are flex parts and for these we need to undo the transformation later
+                    flexflag = 1
+                    uniqueId = str(uuid.uuid4().hex)
+                    material_string = '_' + '_'.join(pa.materials)
+                    written_obj = anygeo.designID + material_string
+                    brick_name = f"brick_{currentpart}_{written_obj}"
 
-                        edges = []
-                        mesh.from_pydata(verts, edges, faces)
+                    if (len(pa.Bones) > flexflag):
+                        # Flex parts are "unique". Ensure they get a unique filename
+                        written_obj = written_obj + "_" + uniqueId
+                        part_matrix = global_matrix
+                        bone_matrices = [invert * b.matrix for b in pa.Bones]
+                    else:
+                        # Flex parts don't need to be moved, but non-flex parts need
+                        transform_matrix = mathutils.Matrix(
+                            (
+                                (n11, n21, n31, n41),
+                                (n12, n22, n32, n42),
+                                (n13, n23, n33, n43),
+                                (n14, n24, n34, n44)
+                            )
+                        )
 
-                        for f in mesh.polygons:
-                            f.use_smooth = True
+                        # Random Scale for brick seams
+                        scalefact = (anygeo.maxGeoBounding - 0.000 * random.uniform(0.0, 1.000)) / anygeo.maxGeoBounding
 
-                        if useNormals:
-                            mesh.calc_normals_split()
-                            mesh.normals_split_custom_set_from_vertices(normals)
-                            mesh.use_auto_smooth = True
+                        scale_matrix = mathutils.Matrix.Scale(scalefact, 4)
+                        part_matrix = global_matrix @ transform_matrix @ scale_matrix
+                        bone_matrices = None
 
-                        geometriecache["geo{0}".format(written_geo)] = mesh.copy()
+                        # miny used for floor plane later
+                        if miny > float(n42):
+                            miny = n42
 
+                    # try catch here for possible problems in materials assignment of various g, g1, g2, .. files in lxf file
+                    last_color = 0
+                    part_materials = []
+                    for part in range(max(len(geo.Parts) for geo in geos.values())):
+                        try:
+                            materialCurrentPart = pa.materials[part]
+                            last_color = pa.materials[part]
+                        except IndexError:
+                            materialCurrentPart = last_color
+                        part_materials.append(self.allMaterials.getMaterialRibyId(materialCurrentPart))
+
+                    if useInstancing and bone_matrices is None:
+                        instanceKey = (anygeo.designID, tuple(lddmatri.materialId for lddmatri in part_materials))
                     else:
-                        mesh = geometriecache["geo{0}".format(written_geo)].copy()
-                        mesh.materials.clear()
+                        instanceKey = None
+
+                    for lod, geo in geos.items():
+                        brick_mesh = instancedMeshes.get((lod, instanceKey))
+                        if brick_mesh is None:
+                            positions, normals = geo.positions, geo.normals
+
+                            # translate / rotate only parts with more then 1 bone. This are flex parts
+                            if bone_matrices:
+                                positions, normals = transformBones(positions, normals, geo.bonemap, bone_matrices)
+
+                            brick_materials = []
+                            used_material_indices = {}
+                            part_material_indices = np.empty(len(geo.Parts), dtype=np.int32)
+                            for part in geo.Parts:
+                                lddmatri = part_materials[part]
+                                if (index := used_material_indices.get(lddmatri.materialId)) is None:
+                                    index = used_material_indices[lddmatri.materialId] = len(brick_materials)
+                                    brick_materials.append(lddmatri)
+                                part_material_indices[part] = index
+
+                            brick_mesh = buildMesh(
+                                brick_name,
+                                positions,
+                                normals if useNormals else None,
+                                geo.faces,
+                                geo.uvs,
+                                part_material_indices[geo.faceParts]
+                            )
+                            for lddmatri in brick_materials:
+                                brick_mesh.materials.append(self.allMaterials.getBlenderMaterial(lddmatri))
+                            if instanceKey is not None:
+                                instancedMeshes[(lod, instanceKey)] = brick_mesh
 
-                    geo_meshes.append(mesh)
+                        brick_obj = bpy.data.objects.new(brick_name, brick_mesh)
+                        brick_obj.matrix_world = part_matrix
+                        collections[lod].objects.link(brick_obj)
 
-                    # try catch here for possible problems in materials assignment of various g, g1, g2, .. files in lxf file
-                    try:
-                        materialCurrentPart = pa.materials[part]
-                        last_color = pa.materials[part]
-                    except IndexError:
-                        materialCurrentPart = last_color
-
-                    lddmatri = self.allMaterials.getMaterialRibyId(materialCurrentPart)
-                    matname = materialCurrentPart
-
-                    if matname not in usedmaterials:
-                        mesh.materials.append(lddmatri.string(None))
-
-                    if len(geo.Parts[part].textures) > 0:
-
-                        mesh.uv_layers.new(do_init=False)
-                        uv_layer = mesh.uv_layers.active.data
-
-                        uvs = []
-                        for text in geo.Parts[part].textures:
-                            uv = [text.x, (-1) * text.y]
-                            uvs.append(uv)
-                        for poly in mesh.polygons:
-                            # range is used here to show how the polygons reference loops,
-                            # for convenience 'poly.loop_indices' can be used instead.
-                            for loop_index in range(poly.loop_start, poly.loop_start + poly.loop_total):
-                                uv_layer[loop_index].uv = uvs[mesh.loops[loop_index].vertex_index]
-
-                used_materials = []
-                used_material_indices = {}
-                bm = bmesh.new()
-                for mesh in geo_meshes:
-                    index_remapping = np.empty(len(mesh.materials), dtype=int)
-                    for i, material in enumerate(mesh.materials):
-                        mat_name = material.name.rsplit(".", 1)[0]
-                        if (index := used_material_indices.get(mat_name)) is not None:
-                            index_remapping[i] = index
-                            bpy.data.materials.remove(material)
-                        else:
-                            index_remapping[i] = len(used_material_indices)
-                            used_material_indices[mat_name] = index_remapping[i]
-                            used_materials.append(material)
-
-                    material_indices = np.empty(len(mesh.polygons), dtype=int)
-                    mesh.polygons.foreach_get("material_index", material_indices)
-                    remapped_indices = index_remapping[material_indices]
-                    mesh.polygons.foreach_set("material_index", remapped_indices)
-
-                    bm.from_mesh(mesh)
-                    bpy.data.meshes.remove(mesh)
-
-                brick_mesh = bpy.data.meshes.new(brick_name)
-                bm.to_mesh(brick_mesh)
-                for material in used_materials:
-                    brick_mesh.materials.append(material)
-
-                if useNormals:
-                    brick_mesh.use_auto_smooth = True
-
-                brick_obj = bpy.data.objects.new(brick_name, brick_mesh)
-                brick_obj.matrix_world = part_matrix
-                col.objects.link(brick_obj)
-
-        for mesh in geometriecache.values():
-            if type(mesh) == bpy.types.Mesh:
-                bpy.data.meshes.remove(mesh)
+            profile["counts"].update(count_geometry(obj for col in collections.values() for obj in col.objects))
 
         useplane = True
         if useplane is True:  # write the floor plane in case True
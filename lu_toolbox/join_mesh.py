@@ -0,0 +1,211 @@
+import bpy
+from mathutils import Matrix
+import numpy as np
+
+# face layer holding the index of the brick each face of a combined mesh came from
+BRICK_LAYER = "LUTB_BRICK"
+
+# Joins mesh objects into the first one and applies their transforms, like selecting them and
+# running bpy.ops.object.join() followed by bpy.ops.object.transform_apply(). Instead of going
+# through the operators, all mesh data is copied with foreach_get/foreach_set, which doesn't
+# slow down with thousands of small objects.
+def join_mesh(objects):
+    target = objects[0]
+
+    # instanced objects share their mesh, its data only needs to be read once
+    mesh_data = {}
+    for obj in objects:
+        if obj.data not in mesh_data:
+            mesh_data[obj.data] = read_mesh(obj.data)
+
+    parts = [(obj, mesh_data[obj.data]) for obj in objects]
+    n_verts = sum(len(data["co"]) for _, data in parts)
+    n_edges = sum(len(data["edges"]) for _, data in parts)
+    n_loops = sum(len(data["vertex_index"]) for _, data in parts)
+    n_polys = sum(len(data["loop_start"]) for _, data in parts)
+
+    materials = []
+    material_indices = {}
+    uv_names = []
+    vc_names = []
+    for obj in objects:
+        for material in obj.data.materials:
+            if material not in material_indices:
+                material_indices[material] = len(materials)
+                materials.append(material)
+        uv_names += [name for name in obj.data.uv_layers.keys() if not name in uv_names]
+        vc_names += [name for name in obj.data.vertex_colors.keys() if not name in vc_names]
+    use_custom_normals = any(data["has_custom_normals"] for data in mesh_data.values())
+
+    co = np.empty((n_verts, 3), dtype=np.float32)
+    edges = np.empty((n_edges, 2), dtype=np.int32)
+    use_edge_sharp = np.empty(n_edges, dtype=bool)
+    use_seam = np.empty(n_edges, dtype=bool)
+    vertex_index = np.empty(n_loops, dtype=np.int32)
+    edge_index = np.empty(n_loops, dtype=np.int32)
+    loop_start = np.empty(n_polys, dtype=np.int32)
+    loop_total = np.empty(n_polys, dtype=np.int32)
+    use_smooth = np.empty(n_polys, dtype=bool)
+    material_index = np.empty(n_polys, dtype=np.int32)
+    select = np.empty(n_polys, dtype=bool)
+    bricks = np.empty(n_polys, dtype=np.int32)
+    uvs = {name: np.zeros((n_loops, 2), dtype=np.float32) for name in uv_names}
+    vcs = {name: np.ones((n_loops, 4), dtype=np.float32) for name in vc_names}
+    normals = np.empty((n_loops, 3), dtype=np.float32) if use_custom_normals else None
+
+    vert_offset = edge_offset = loop_offset = poly_offset = brick_offset = 0
+    for obj, data in parts:
+        verts = slice(vert_offset, vert_offset + len(data["co"]))
+        edges_ = slice(edge_offset, edge_offset + len(data["edges"]))
+        loops = slice(loop_offset, loop_offset + len(data["vertex_index"]))
+        polys = slice(poly_offset, poly_offset + len(data["loop_start"]))
+
+        matrix = np.array(obj.matrix_world, dtype=np.float32)
+        co[verts] = data["co"] @ matrix[:3, :3].T + matrix[:3, 3]
+
+        edges[edges_] = data["edges"] + vert_offset
+        use_edge_sharp[edges_] = data["use_edge_sharp"]
+        use_seam[edges_] = data["use_seam"]
+
+        vertex_index[loops] = data["vertex_index"] + vert_offset
+        edge_index[loops] = data["edge_index"] + edge_offset
+
+        loop_start[polys] = data["loop_start"] + loop_offset
+        loop_total[polys] = data["loop_total"]
+        use_smooth[polys] = data["use_smooth"]
+        select[polys] = data["select"]
+        # objects that were combined before keep their bricks apart
+        if data["bricks"] is not None and len(data["bricks"]):
+            bricks[polys] = data["bricks"] + brick_offset
+            brick_offset += data["bricks"].max() + 1
+        else:
+            bricks[polys] = brick_offset
+            brick_offset += 1
+        if obj.data.materials:
+            remap = np.array([material_indices[material] for material in obj.data.materials], dtype=np.int32)
+            material_index[polys] = remap[np.minimum(data["material_index"], len(remap) - 1)]
+        else:
+            material_index[polys] = 0
+
+        for name, uv in data["uvs"].items():
+            uvs[name][loops] = uv
+        for name, vc in data["vcs"].items():
+            vcs[name][loops] = vc
+
+        if use_custom_normals:
+            # normals transform with the inverse transpose, which keeps them perpendicular under scaling
+            normal_matrix = np.linalg.inv(matrix[:3, :3]).T
+            if "split_normals" not in data:
+                data["split_normals"] = read_split_normals(obj.data)
+            loop_normals = data["split_normals"] @ normal_matrix.T
+            lengths = np.linalg.norm(loop_normals, axis=1, keepdims=True)
+            np.divide(loop_normals, lengths, out=loop_normals, where=lengths > 0)
+            normals[loops] = loop_normals
+
+        vert_offset = verts.stop
+        edge_offset = edges_.stop
+        loop_offset = loops.stop
+        poly_offset = polys.stop
+
+    name = target.data.name
+    mesh = write_mesh(name, {
+        "co": co,
+        "edges": edges,
+        "use_edge_sharp": use_edge_sharp,
+        "use_seam": use_seam,
+        "vertex_index": vertex_index,
+        "edge_index": edge_index,
+        "loop_start": loop_start,
+        "loop_total": loop_total,
+        "use_smooth": use_smooth,
+        "material_index": material_index,
+        "select": select,
+        "bricks": bricks,
+        "uvs": uvs,
+        "vcs": vcs,
+    }, materials, target.data, normals)
+
+    old_meshes = list(mesh_data)
+    target.data = mesh
+    target.matrix_world = Matrix.Identity(4)
+
+    bpy.data.batch_remove(objects[1:])
+    bpy.data.batch_remove([old_mesh for old_mesh in old_meshes if old_mesh.users == 0])
+    mesh.name = name
+
+    return target
+
+def get(collection, attribute, size, dtype, components=1):
+    buffer = np.empty(size * components, dtype=dtype)
+    collection.foreach_get(attribute, buffer)
+    return buffer.reshape((size, components)) if components > 1 else buffer
+
+def read_mesh(mesh):
+    n_verts = len(mesh.vertices)
+    n_edges = len(mesh.edges)
+    n_loops = len(mesh.loops)
+    n_polys = len(mesh.polygons)
+
+    return {
+        "co": get(mesh.vertices, "co", n_verts, np.float32, 3),
+        "edges": get(mesh.edges, "vertices", n_edges, np.int32, 2),
+        "use_edge_sharp": get(mesh.edges, "use_edge_sharp", n_edges, bool),
+        "use_seam": get(mesh.edges, "use_seam", n_edges, bool),
+        "vertex_index": get(mesh.loops, "vertex_index", n_loops, np.int32),
+        "edge_index": get(mesh.loops, "edge_index", n_loops, np.int32),
+        "loop_start": get(mesh.polygons, "loop_start", n_polys, np.int32),
+        "loop_total": get(mesh.polygons, "loop_total", n_polys, np.int32),
+        "use_smooth": get(mesh.polygons, "use_smooth", n_polys, bool),
+        "material_index": get(mesh.polygons, "material_index", n_polys, np.int32),
+        "select": get(mesh.polygons, "select", n_polys, bool),
+        "bricks": get(layer.data, "value", n_polys, np.int32)
+            if (layer := mesh.polygon_layers_int.get(BRICK_LAYER)) else None,
+        "uvs": {uv_layer.name: get(uv_layer.data, "uv", n_loops, np.float32, 2) for uv_layer in mesh.uv_layers},
+        "vcs": {vc.name: get(vc.data, "color", n_loops, np.float32, 4) for vc in mesh.vertex_colors},
+        "has_custom_normals": mesh.has_custom_normals,
+    }
+
+# as soon as one part has custom normals, all parts need theirs to keep shading the same
+def read_split_normals(mesh):
+    mesh.calc_normals_split()
+    return get(mesh.loops, "normal", len(mesh.loops), np.float32, 3)
+
+# Writes mesh data in the format returned by read_mesh into a new mesh. Auto smooth settings are
+# taken from the template mesh, custom normals are given per loop.
+def write_mesh(name, data, materials, template, normals=None):
+    mesh = bpy.data.meshes.new(name)
+
+    mesh.vertices.add(len(data["co"]))
+    mesh.vertices.foreach_set("co", data["co"].ravel())
+    mesh.edges.add(len(data["edges"]))
+    mesh.edges.foreach_set("vertices", data["edges"].ravel())
+    mesh.edges.foreach_set("use_edge_sharp", data["use_edge_sharp"])
+    mesh.edges.foreach_set("use_seam", data["use_seam"])
+    mesh.loops.add(len(data["vertex_index"]))
+    mesh.loops.foreach_set("vertex_index", data["vertex_index"])
+    mesh.loops.foreach_set("edge_index", data["edge_index"])
+    mesh.polygons.add(len(data["loop_start"]))
+    mesh.polygons.foreach_set("loop_start", data["loop_start"])
+    mesh.polygons.foreach_set("loop_total", data["loop_total"])
+    mesh.polygons.foreach_set("use_smooth", data["use_smooth"])
+    mesh.polygons.foreach_set("material_index", data["material_index"])
+    for material in materials:
+        mesh.materials.append(material)
+    mesh.update()
+    mesh.polygons.foreach_set("select", data["select"])
+
+    for uv_name, uv in data["uvs"].items():
+        uv_layer = mesh.uv_layers.new(name=uv_name, do_init=False)
+        uv_layer.data.foreach_set("uv", uv.ravel())
+    for vc_name, vc in data["vcs"].items():
+        vc_layer = mesh.vertex_colors.new(name=vc_name, do_init=False)
+        vc_layer.data.foreach_set("color", vc.ravel())
+    if data.get("bricks") is not None:
+        mesh.polygon_layers_int.new(name=BRICK_LAYER).data.foreach_set("value", data["bricks"])
+
+    mesh.use_auto_smooth = template.use_auto_smooth or normals is not None
+    mesh.auto_smooth_angle = template.auto_smooth_angle
+    if normals is not None:
+        mesh.normals_split_custom_set(normals)
+
+    return mesh
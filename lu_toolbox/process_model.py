@@ -9,6 +9,8 @@ from timeit import default_timer as timer
 from .remove_hidden_faces import LUTB_OT_remove_hidden_faces
 from .materials import *
 from .divide_mesh import divide_mesh
+from .join_mesh import join_mesh, BRICK_LAYER
+from .profiling import stage
 
 IS_TRANSPARENT = "lu_toolbox_is_transparent"
 
@@ -31,16 +33,23 @@ class LUTB_OT_process_model(bpy.types.Operator):
         scene.render.engine = "CYCLES"
         scene.cycles.device = "GPU" if scene.lutb_process_use_gpu else "CPU"
 
+        mesh_objects = []
         for obj in scene.collection.all_objects:
             if not obj.type == "MESH":
                 continue
+            mesh_objects.append(obj)
 
             mat_names = {material.name.rsplit(".", 1)[0] for material in obj.data.materials}
             if mat_names.issubset(MATERIALS_TRANSPARENT):
                 obj[IS_TRANSPARENT] = True
 
+        color_variations = {}
+        if scene.lutb_apply_vertex_colors and scene.lutb_use_color_variation:
+            color_variations = self.assign_color_variation(context, scene.collection.children)
+
         if scene.lutb_combine_objects:
-            self.combine_objects(context, scene.collection.children)
+            with stage("combine", objects=lambda: scene.collection.all_objects):
+                self.combine_objects(context, scene.collection.children)
 
         context.view_layer.update()
 
@@ -72,6 +81,8 @@ class LUTB_OT_process_model(bpy.types.Operator):
         if not all_objects:
             return {"FINISHED"}
 
+        self.make_single_user(all_objects)
+
         if not scene.lutb_keep_uvs:
             self.clear_uvs(all_objects)
 
@@ -79,13 +90,14 @@ class LUTB_OT_process_model(bpy.types.Operator):
             self.reset_orientation(all_objects)
 
         if scene.lutb_apply_vertex_colors:
-            if scene.lutb_correct_colors:
-                self.correct_colors(context, all_objects)
+            with stage("vertex_colors", objects=all_objects):
+                if scene.lutb_correct_colors:
+                    self.correct_colors(context, all_objects)
 
-            if scene.lutb_use_color_variation:
-                self.apply_color_variation(context, scene.collection.children)
+                if scene.lutb_use_color_variation:
+                    self.apply_color_variation(color_variations)
 
-            self.apply_vertex_colors(context, all_objects)
+                self.apply_vertex_colors(context, all_objects)
 
         if scene.lutb_setup_bake_mat:
             self.setup_bake_mat(context, all_objects)
@@ -94,16 +106,21 @@ class LUTB_OT_process_model(bpy.types.Operator):
             for obj in transparent_objects:
                 obj.hide_render = True
 
-            self.remove_hidden_faces(context, opaque_objects)
+            with stage("hsr", objects=opaque_objects):
+                self.remove_hidden_faces(context, opaque_objects)
 
             for obj in transparent_objects:
                 obj.hide_render = False
 
-        new_objects = self.split_objects(context, scene.collection.children)
+        with stage("split", objects=lambda: scene.collection.all_objects):
+            new_objects = self.split_objects(context, scene.collection.children)
         all_objects += new_objects
 
+        self.remove_brick_layer(all_objects)
+
         if scene.lutb_setup_lod_data:
-            self.setup_lod_data(context, scene.collection.children)
+            with stage("lod_setup", objects=all_objects):
+                self.setup_lod_data(context, scene.collection.children)
 
         bpy.ops.object.select_all(action="DESELECT")
         for obj in all_objects:
@@ -115,19 +132,32 @@ class LUTB_OT_process_model(bpy.types.Operator):
 
         return {"FINISHED"}
 
+    def make_single_user(self, objects):
+        # instanced imports share meshes between identical bricks, but everything
+        # below modifies mesh data per object
+        for obj in objects:
+            if obj.data.users > 1:
+                obj.data = obj.data.copy()
+
+    def remove_brick_layer(self, objects):
+        # the per-face brick ids are only needed for hidden surface removal
+        for obj in objects:
+            if layer := obj.data.polygon_layers_int.get(BRICK_LAYER):
+                obj.data.polygon_layers_int.remove(layer)
+
     def clear_uvs(self, objects):
         for obj in objects:
             for uv_layer in reversed(obj.data.uv_layers):
                 obj.data.uv_layers.remove(uv_layer)
 
     def reset_orientation(self, objects):
+        # same result as applying all transforms, rotating by -90 degrees around X, applying
+        # again and rotating back, but without going through transform_apply for every object
+        rotation = Matrix.Rotation(radians(90), 4, "X")
+        rotation_inv = Matrix.Rotation(radians(-90), 4, "X")
         for obj in objects:
-            obj.select_set(True)
-            bpy.ops.object.transform_apply()
-            obj.rotation_euler = (radians(-90), 0, 0)
-            bpy.ops.object.transform_apply()
-            obj.rotation_euler = (radians(90), 0, 0)
-            obj.select_set(False)
+            obj.data.transform(rotation_inv @ obj.matrix_world)
+            obj.matrix_world = rotation
 
     def combine_objects(self, context, collections):
         scene = context.scene
@@ -161,15 +191,7 @@ class LUTB_OT_process_model(bpy.types.Operator):
                         joined_transparent[IS_TRANSPARENT] = True
 
     def join_objects(self, context, objects):
-        bpy.ops.object.select_all(action="DESELECT")
-        for obj in objects:
-            obj.select_set(True)
-
-        joined = objects[0]
-        context.view_layer.objects.active = joined
-        bpy.ops.object.join()
-        bpy.ops.object.transform_apply()
-        return joined
+        return join_mesh(objects)
 
     def correct_colors(self, context, objects):
         for obj in objects:
@@ -180,25 +202,50 @@ class LUTB_OT_process_model(bpy.types.Operator):
                 elif color := MATERIALS_TRANSPARENT.get(name):
                     material.diffuse_color = color
 
-    def apply_color_variation(self, context, collections):
+    # Picks a brightness shift for every material of every brick, before bricks are combined.
+    # The importer shares one material per color, so bricks get copies of it for their shift.
+    # Shifts are rounded to steps of 1/255, which is all that 8 bit vertex colors can show
+    # anyway, and bricks with the same color and step share a copy. That keeps the number of
+    # materials at a few per color instead of one per brick. Returns {material: shift}.
+    def assign_color_variation(self, context, collections):
         initial_state = random.getstate()
         variation = context.scene.lutb_color_variation
 
+        variations = {}
+        copies = {}
         for collection in collections:
             for lod_collection in collection.children:
                 random.setstate(initial_state)
                 for obj in list(lod_collection.objects):
                     if obj.type == "MESH":
+                        steps = []
                         for material in obj.data.materials:
-                            color = Color(material.diffuse_color[:3])
-                            gamma = color.v ** (1 / 2.224)
-
                             custom_variation = CUSTOM_VARIATION.get(material.name.rsplit(".", 1)[0])
                             var = variation if custom_variation is None else variation * custom_variation
-                            gamma += random.uniform(-var / 200, var / 200)
-
-                            color.v = min(max(0, gamma), 1) ** 2.224
-                            material.diffuse_color = (*color, 1.0)
+                            steps.append(round(random.uniform(-var / 200, var / 200) * 255))
+
+                        # instanced meshes only need their own copy if their materials change
+                        if not any(steps):
+                            continue
+                        if obj.data.users > 1:
+                            obj.data = obj.data.copy()
+
+                        mesh = obj.data
+                        for i, (material, step) in enumerate(zip(mesh.materials, steps)):
+                            if (varied := copies.get((material, step))) is None:
+                                varied = material.copy() if step else material
+                                copies[(material, step)] = varied
+                                variations[varied] = step / 255
+                            mesh.materials[i] = varied
+
+        return variations
+
+    def apply_color_variation(self, variations):
+        for material, shift in variations.items():
+            color = Color(material.diffuse_color[:3])
+            gamma = color.v ** (1 / 2.224) + shift
+            color.v = min(max(0, gamma), 1) ** 2.224
+            material.diffuse_color = (*color, 1.0)
 
     def apply_vertex_colors(self, context, objects):
         scene = context.scene
@@ -208,78 +255,91 @@ class LUTB_OT_process_model(bpy.types.Operator):
             mesh = obj.data
             n_loops = len(mesh.loops)
 
+            # per loop material indices, shared by all layers that color by material
+            loop_material_indices = None
+            def per_material(colors):
+                nonlocal loop_material_indices
+                if len(colors) == 1:
+                    return np.tile(colors[0], n_loops)
+                if loop_material_indices is None:
+                    loop_material_indices = self.get_loop_material_indices(mesh)
+                return colors[loop_material_indices].ravel()
+
             if not is_transparent:
                 if not (vc_lit := mesh.vertex_colors.get("Lit")):
                     vc_lit = mesh.vertex_colors.new(name="Lit")
-                lit_data = np.tile((0.0, 0.0, 0.0, 1.0), n_loops)
+                lit_data = np.tile(np.array((0.0, 0.0, 0.0, 1.0), dtype=np.float32), n_loops)
                 vc_lit.data.foreach_set("color", lit_data)
 
             if not (vc_col := mesh.vertex_colors.get("Col")):
                 vc_col = mesh.vertex_colors.new(name="Col")
 
-            if len(mesh.materials) < 2:
-                if mesh.materials:
-                    color = lin2srgb(mesh.materials[0].diffuse_color)
-                else:
-                    color = (0.8, 0.8, 0.8, 1.0)
-
-                if is_transparent:
-                    color[3] = scene.lutb_transparent_opacity / 100.0
-
-                color_data = np.tile(color, n_loops)
-
+            if mesh.materials:
+                colors = np.array([lin2srgb(mat.diffuse_color) for mat in mesh.materials], dtype=np.float32)
             else:
-                colors = np.empty((len(mesh.materials), 4))
-                for i, material in enumerate(mesh.materials):
-                    colors[i] = lin2srgb(material.diffuse_color)
+                colors = np.array(((0.8, 0.8, 0.8, 1.0),), dtype=np.float32)
 
-                if is_transparent:
-                    colors[:, 3] = scene.lutb_transparent_opacity / 100.0
+            if is_transparent:
+                colors[:, 3] = scene.lutb_transparent_opacity / 100.0
 
-                color_indices = np.zeros(len(mesh.loops), dtype=int)
-                for poly in mesh.polygons:
-                    poly_loop_end = poly.loop_start + poly.loop_total
-                    color_indices[poly.loop_start:poly_loop_end] = poly.material_index
-
-                color_data = colors[color_indices].flatten()
-
-            vc_col.data.foreach_set("color", color_data)
+            vc_col.data.foreach_set("color", per_material(colors))
 
             if not is_transparent:
-                if not (vc_alpha := mesh.vertex_colors.get("Alpha")):
-                    vc_alpha = mesh.vertex_colors.new(name="Alpha")
-                alpha_data = np.tile((1.0, 1.0, 1.0, 1.0), n_loops)
-                vc_alpha.data.foreach_set("color", alpha_data)
+                # alpha either gets its own layer or lives in the alpha channel of Lit, which
+                # is where bake lighting puts it in the end anyway
+                if scene.lutb_pack_alpha:
+                    if vc_alpha := mesh.vertex_colors.get("Alpha"):
+                        mesh.vertex_colors.remove(vc_alpha)
+                else:
+                    if not (vc_alpha := mesh.vertex_colors.get("Alpha")):
+                        vc_alpha = mesh.vertex_colors.new(name="Alpha")
+                    alpha_data = np.ones(n_loops * 4, dtype=np.float32)
+                    vc_alpha.data.foreach_set("color", alpha_data)
 
                 if not (vc_glow := mesh.vertex_colors.get("Glow")):
                     vc_glow = mesh.vertex_colors.new(name="Glow")
 
                 mat_names = [mat.name.rsplit(".", 1)[0] for mat in mesh.materials]
                 if set(mat_names) & set(MATERIALS_GLOW):
-                    colors = np.empty((len(mesh.materials), 4))
-                    for i, (name, material) in enumerate(zip(mat_names, mesh.materials)):
+                    colors = np.empty((len(mesh.materials), 4), dtype=np.float32)
+                    for i, name in enumerate(mat_names):
                         color = MATERIALS_GLOW.get(name)
                         colors[i] = lin2srgb(color) if color else (0.0, 0.0, 0.0, 1.0)
-
-                    color_indices = np.zeros(len(mesh.loops), dtype=int)
-                    for poly in mesh.polygons:
-                        poly_loop_end = poly.loop_start + poly.loop_total
-                        color_indices[poly.loop_start:poly_loop_end] = poly.material_index
-
-                    glow_data = colors[color_indices].flatten()
+                    glow_data = per_material(colors)
                 else:
-                    glow_data = np.tile((0.0, 0.0, 0.0, 1.0), n_loops)
+                    glow_data = np.tile(np.array((0.0, 0.0, 0.0, 1.0), dtype=np.float32), n_loops)
 
                 vc_glow.data.foreach_set("color", glow_data)
 
             # no clue why setting .active doesn't work ...
             mesh.vertex_colors.active_index = mesh.vertex_colors.keys().index("Col")
 
-        shading = context.area.spaces[0].shading
-        shading.type = "SOLID"
-        shading.light = "FLAT"
-        shading.color_type = "VERTEX"
-        shading.show_backface_culling = True
+        # there is no viewport to set up when running in the background
+        if context.area and context.area.type == "VIEW_3D":
+            shading = context.area.spaces[0].shading
+            shading.type = "SOLID"
+            shading.light = "FLAT"
+            shading.color_type = "VERTEX"
+            shading.show_backface_culling = True
+
+    def get_loop_material_indices(self, mesh):
+        n_polys = len(mesh.polygons)
+        material_indices = np.empty(n_polys, dtype=np.int32)
+        mesh.polygons.foreach_get("material_index", material_indices)
+        loop_starts = np.empty(n_polys, dtype=np.int32)
+        mesh.polygons.foreach_get("loop_start", loop_starts)
+        loop_totals = np.empty(n_polys, dtype=np.int32)
+        mesh.polygons.foreach_get("loop_total", loop_totals)
+
+        # polygons usually store their loops in order, but don't rely on it
+        poly_offsets = np.cumsum(loop_totals) - loop_totals
+        loop_indices = np.arange(len(mesh.loops)) + np.repeat(loop_starts - poly_offsets, loop_totals)
+
+        loop_material_indices = np.zeros(len(mesh.loops), dtype=np.int32)
+        loop_material_indices[loop_indices] = np.repeat(
+            np.minimum(material_indices, max(len(mesh.materials) - 1, 0)), loop_totals
+        )
+        return loop_material_indices
 
     def setup_bake_mat(self, context, objects):
         if not (bake_mat := context.scene.lutb_bake_mat):
@@ -307,14 +367,20 @@ class LUTB_OT_process_model(bpy.types.Operator):
             obj.select_set(True)
 
             bpy.ops.lutb.remove_hidden_faces(
+                engine=scene.lutb_hsr_engine,
                 autoremove=scene.lutb_hsr_autoremove,
                 vc_pre_pass=scene.lutb_hsr_vc_pre_pass,
                 vc_pre_pass_samples=scene.lutb_hsr_vc_pre_pass_samples,
+                coplanar_pre_pass=scene.lutb_hsr_coplanar_pre_pass,
+                voxel_pre_pass=scene.lutb_hsr_voxel_pre_pass,
+                voxel_resolution=scene.lutb_hsr_voxel_resolution,
                 ignore_lights=scene.lutb_hsr_ignore_lights,
                 tris_to_quads=scene.lutb_hsr_tris_to_quads,
                 pixels_between_verts=scene.lutb_hsr_pixels_between_verts,
                 samples=scene.lutb_hsr_samples,
+                max_atlas_size=scene.lutb_hsr_max_atlas_size,
                 use_ground_plane=scene.lutb_hsr_use_ground_plane,
+                raycast_rays=scene.lutb_hsr_raycast_rays,
             )
 
     def split_objects(self, context, collections):
@@ -497,6 +563,7 @@ class LUTB_PT_apply_vertex_colors(LUToolboxPanel, bpy.types.Panel):
         col.enabled = scene.lutb_use_color_variation
 
         layout.prop(scene, "lutb_transparent_opacity")
+        layout.prop(scene, "lutb_pack_alpha")
 
 class LUTB_PT_setup_bake_mat(LUToolboxPanel, bpy.types.Panel):
     bl_label = "Setup Bake Material"
@@ -532,18 +599,30 @@ class LUTB_PT_remove_hidden_faces(LUToolboxPanel, bpy.types.Panel):
         layout.use_property_decorate = False
         layout.active = scene.lutb_remove_hidden_faces
 
+        layout.prop(scene, "lutb_hsr_engine")
         layout.prop(scene, "lutb_hsr_autoremove")
+        layout.prop(scene, "lutb_hsr_use_ground_plane")
+        layout.prop(scene, "lutb_hsr_coplanar_pre_pass")
+
+        if scene.lutb_hsr_engine == "RAYCAST":
+            layout.prop(scene, "lutb_hsr_raycast_rays")
+            return
 
         layout.prop(scene, "lutb_hsr_vc_pre_pass")
         row = layout.row()
         row.prop(scene, "lutb_hsr_vc_pre_pass_samples", slider=True)
         row.enabled = scene.lutb_hsr_vc_pre_pass
 
+        layout.prop(scene, "lutb_hsr_voxel_pre_pass")
+        row = layout.row()
+        row.prop(scene, "lutb_hsr_voxel_resolution")
+        row.enabled = scene.lutb_hsr_voxel_pre_pass
+
         layout.prop(scene, "lutb_hsr_ignore_lights")
         layout.prop(scene, "lutb_hsr_tris_to_quads")
-        layout.prop(scene, "lutb_hsr_use_ground_plane")
         layout.prop(scene, "lutb_hsr_pixels_between_verts", slider=True)
         layout.prop(scene, "lutb_hsr_samples", slider=True)
+        layout.prop(scene, "lutb_hsr_max_atlas_size")
 
 class LUTB_PT_setup_metadata(LUToolboxPanel, bpy.types.Panel):
     bl_label = "Setup Metadata"
@@ -602,6 +681,9 @@ def register():
         "Percentage of transparent brick opacity. "\
         "This controls how see-through the models transparent bricks appear in LU. "\
         "Lower values result in more transparency")
+    bpy.types.Scene.lutb_pack_alpha = BoolProperty(name="Pack Alpha into Lit", default=False, description=""\
+        "Store alpha in the alpha channel of the Lit layer instead of a separate Alpha layer. "\
+        "Saves one vertex color layer per mesh")
     bpy.types.Scene.lutb_apply_vertex_colors = BoolProperty(name="Apply Vertex Colors", default=True, description=""\
         "Apply vertex colors to the model")
 
@@ -613,12 +695,21 @@ def register():
 
     bpy.types.Scene.lutb_remove_hidden_faces = BoolProperty(name="Remove Hidden Faces", default=True,
         description=LUTB_OT_remove_hidden_faces.__doc__)
+    bpy.types.Scene.lutb_hsr_engine = EnumProperty(name="Engine", default="BAKE",
+        items=LUTB_OT_remove_hidden_faces.__annotations__["engine"].keywords["items"],
+        description=LUTB_OT_remove_hidden_faces.__annotations__["engine"].keywords["description"])
     bpy.types.Scene.lutb_hsr_autoremove = BoolProperty(name="Autoremove", default=True,
         description=LUTB_OT_remove_hidden_faces.__annotations__["autoremove"].keywords["description"])
     bpy.types.Scene.lutb_hsr_vc_pre_pass = BoolProperty(name="Vertex Color Pre-Pass", default=True,
         description=LUTB_OT_remove_hidden_faces.__annotations__["vc_pre_pass"].keywords["description"])
     bpy.types.Scene.lutb_hsr_vc_pre_pass_samples = IntProperty(name="Pre-Pass Samples", min=0, default=32, soft_max=64,
         description=LUTB_OT_remove_hidden_faces.__annotations__["vc_pre_pass_samples"].keywords["description"])
+    bpy.types.Scene.lutb_hsr_coplanar_pre_pass = BoolProperty(name="Coplanar Pre-Pass", default=False,
+        description=LUTB_OT_remove_hidden_faces.__annotations__["coplanar_pre_pass"].keywords["description"])
+    bpy.types.Scene.lutb_hsr_voxel_pre_pass = BoolProperty(name="Voxel Pre-Pass", default=False,
+        description=LUTB_OT_remove_hidden_faces.__annotations__["voxel_pre_pass"].keywords["description"])
+    bpy.types.Scene.lutb_hsr_voxel_resolution = IntProperty(name="Resolution", min=16, default=128, max=512,
+        description=LUTB_OT_remove_hidden_faces.__annotations__["voxel_resolution"].keywords["description"])
     bpy.types.Scene.lutb_hsr_ignore_lights = BoolProperty(name="Ignore Lights", default=True,
         description=LUTB_OT_remove_hidden_faces.__annotations__["ignore_lights"].keywords["description"])
     bpy.types.Scene.lutb_hsr_tris_to_quads = BoolProperty(name="Tris to Quads", default=True,
@@ -627,8 +718,12 @@ def register():
         description=LUTB_OT_remove_hidden_faces.__annotations__["pixels_between_verts"].keywords["description"])
     bpy.types.Scene.lutb_hsr_samples = IntProperty(name="Samples", min=0, default=8, soft_max=32,
         description=LUTB_OT_remove_hidden_faces.__annotations__["samples"].keywords["description"])
+    bpy.types.Scene.lutb_hsr_max_atlas_size = IntProperty(name="Max Atlas Size", min=64, default=4096, max=16384,
+        subtype="PIXEL", description=LUTB_OT_remove_hidden_faces.__annotations__["max_atlas_size"].keywords["description"])
     bpy.types.Scene.lutb_hsr_use_ground_plane = BoolProperty(name="Use Ground Plane", default=False,
         description=LUTB_OT_remove_hidden_faces.__annotations__["use_ground_plane"].keywords["description"])
+    bpy.types.Scene.lutb_hsr_raycast_rays = IntProperty(name="Rays", min=1, default=64, soft_max=256,
+        description=LUTB_OT_remove_hidden_faces.__annotations__["raycast_rays"].keywords["description"])
 
     bpy.types.Scene.lutb_setup_lod_data = BoolProperty(name="Setup LOD Data", default=True)
     bpy.types.Scene.lutb_correct_orientation = BoolProperty(name="Correct Orientation", default=True)
@@ -654,20 +749,27 @@ def unregister():
     del bpy.types.Scene.lutb_color_variation
 
     del bpy.types.Scene.lutb_transparent_opacity
+    del bpy.types.Scene.lutb_pack_alpha
     del bpy.types.Scene.lutb_apply_vertex_colors
 
     del bpy.types.Scene.lutb_setup_bake_mat
     del bpy.types.Scene.lutb_bake_mat
 
     del bpy.types.Scene.lutb_remove_hidden_faces
+    del bpy.types.Scene.lutb_hsr_engine
     del bpy.types.Scene.lutb_hsr_autoremove
     del bpy.types.Scene.lutb_hsr_vc_pre_pass
     del bpy.types.Scene.lutb_hsr_vc_pre_pass_samples
+    del bpy.types.Scene.lutb_hsr_coplanar_pre_pass
+    del bpy.types.Scene.lutb_hsr_voxel_pre_pass
+    del bpy.types.Scene.lutb_hsr_voxel_resolution
     del bpy.types.Scene.lutb_hsr_ignore_lights
     del bpy.types.Scene.lutb_hsr_tris_to_quads
     del bpy.types.Scene.lutb_hsr_pixels_between_verts
     del bpy.types.Scene.lutb_hsr_samples
+    del bpy.types.Scene.lutb_hsr_max_atlas_size
     del bpy.types.Scene.lutb_hsr_use_ground_plane
+    del bpy.types.Scene.lutb_hsr_raycast_rays
 
     del bpy.types.Scene.lutb_setup_lod_data
     del bpy.types.Scene.lutb_correct_orientation
@@ -0,0 +1,173 @@
+import bpy
+from bpy.props import BoolProperty, StringProperty
+from bpy_extras.io_utils import ExportHelper
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Every stage the toolbox goes through (DB load, scene parse, mesh build, combine, HSR, baking, ...)
+# is recorded with its wall time, CPU time, the process' peak memory and object/face/loop counts.
+# Records collect across operator runs until they are exported or cleared.
+class Profiler:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.records = []
+        self.origin = time.perf_counter()
+        self.depth = 0
+
+    def begin(self, name, **counts):
+        self.depth += 1
+        return {
+            "name": name,
+            "depth": self.depth - 1,
+            "thread": threading.get_ident(),
+            "start": time.perf_counter() - self.origin,
+            "cpu_start": time.process_time(),
+            "counts": counts,
+        }
+
+    def end(self, record, objects=None):
+        self.depth -= 1
+        record["wall"] = time.perf_counter() - self.origin - record["start"]
+        record["cpu"] = time.process_time() - record.pop("cpu_start")
+        record["peak_rss"] = get_peak_rss()
+        if objects is not None:
+            record["counts"].update(count_geometry(objects() if callable(objects) else objects))
+        self.records.append(record)
+        return record
+
+    # `objects` may be a callable, so stages that create or delete objects count their result
+    @contextmanager
+    def stage(self, name, objects=None, **counts):
+        record = self.begin(name, **counts)
+        try:
+            yield record
+        finally:
+            self.end(record, objects)
+
+    def to_dict(self):
+        return {
+            "version": 1,
+            "pid": os.getpid(),
+            "stages": sorted(self.records, key=lambda record: record["start"]),
+        }
+
+    def save_json(self, filepath):
+        with open(filepath, "w", encoding="utf-8") as file:
+            json.dump(self.to_dict(), file, indent=2)
+
+    # chrome://tracing and Perfetto load this directly, nested stages show up as nested slices
+    def save_chrome_trace(self, filepath):
+        pid = os.getpid()
+        events = []
+        for record in self.records:
+            events.append({
+                "name": record["name"],
+                "cat": "lutb",
+                "ph": "X",
+                "ts": record["start"] * 1e6,
+                "dur": record["wall"] * 1e6,
+                "pid": pid,
+                "tid": record["thread"],
+                "args": {"cpu": record["cpu"], "peak_rss": record["peak_rss"], **record["counts"]},
+            })
+
+        with open(filepath, "w", encoding="utf-8") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
+
+profiler = Profiler()
+stage = profiler.stage
+
+def count_geometry(objects):
+    counts = {"objects": 0, "faces": 0, "loops": 0}
+    for obj in objects:
+        try:
+            if obj.type != "MESH":
+                continue
+            counts["objects"] += 1
+            counts["faces"] += len(obj.data.polygons)
+            counts["loops"] += len(obj.data.loops)
+        except ReferenceError:
+            # removed while the stage ran, e.g. joined into another object
+            continue
+    return counts
+
+def get_peak_rss():
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes everywhere else
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        get_current_process = ctypes.windll.kernel32.GetCurrentProcess
+        get_current_process.restype = wintypes.HANDLE
+        get_process_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+        get_process_memory_info.argtypes = (
+            wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD
+        )
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        if get_process_memory_info(get_current_process(), ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+
+    return None
+
+def chrome_trace_path(filepath):
+    return os.path.splitext(filepath)[0] + ".trace.json"
+
+class LUTB_OT_export_profile(bpy.types.Operator, ExportHelper):
+    """Export per stage timings and memory usage of the toolbox as JSON and as a Chrome trace"""
+    bl_idname = "lutb.export_profile"
+    bl_label = "Export Profile"
+
+    filename_ext = ".json"
+    filter_glob: StringProperty(default="*.json", options={"HIDDEN"})
+    clear: BoolProperty(name="Clear", default=True, description=""\
+        "Start a new profile after exporting")
+
+    def execute(self, context):
+        if not profiler.records:
+            self.report({"WARNING"}, "Nothing has been profiled yet")
+            return {"CANCELLED"}
+
+        profiler.save_json(self.filepath)
+        profiler.save_chrome_trace(chrome_trace_path(self.filepath))
+        if self.clear:
+            profiler.clear()
+
+        return {"FINISHED"}
+
+def register():
+    bpy.utils.register_class(LUTB_OT_export_profile)
+
+def unregister():
+    bpy.utils.unregister_class(LUTB_OT_export_profile)
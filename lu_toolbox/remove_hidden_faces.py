@@ -1,11 +1,16 @@
 import bpy, bmesh
 from mathutils import Vector, Matrix
-from bpy.props import IntProperty, FloatProperty, BoolProperty
+from mathutils.bvhtree import BVHTree
+from bpy.props import IntProperty, FloatProperty, BoolProperty, EnumProperty
 import math
 import numpy as np
 
 from timeit import default_timer as timer
 
+from .profiling import stage
+from .join_mesh import BRICK_LAYER
+from .divide_mesh import connected_components
+
 LUTB_HSR_ID = "LUTB_HSR"
 
 class LUTB_OT_remove_hidden_faces(bpy.types.Operator):
@@ -13,6 +18,11 @@ class LUTB_OT_remove_hidden_faces(bpy.types.Operator):
     bl_idname = "lutb.remove_hidden_faces"
     bl_label = "Remove Hidden Faces"
 
+    engine               : EnumProperty(name="Engine", default="BAKE", items=(
+        ("BAKE", "Cycles Bake", "Bake the lighting of an overexposed world and remove faces that stay dark"),
+        ("RAYCAST", "Ray Cast", "Cast rays from each face and remove faces from which none of them escape. "\
+            "Doesn't need Cycles"),
+    ), description="Method used to find hidden faces")
     autoremove           : BoolProperty(default=True, description=""\
         "Automatically remove hidden polygons. "\
         "Disabling this results in hidden polygons being assigned to the objects Face Maps"
@@ -20,6 +30,15 @@ class LUTB_OT_remove_hidden_faces(bpy.types.Operator):
     vc_pre_pass          : BoolProperty(default=True, description=""\
         "Use vertex color baking based pre-pass to quickly sort out faces that are"\
         "definitely visible.")
+    coplanar_pre_pass    : BoolProperty(default=False, description=""\
+        "Find faces that are fully covered by a face of another brick facing the opposite "\
+        "way, like the faces between two stacked bricks, and remove them without baking")
+    voxel_pre_pass       : BoolProperty(default=False, description=""\
+        "Voxelize the model and flood fill the air around it to sort out faces that are "\
+        "clearly visible or enclosed by the model before baking. "\
+        "Openings smaller than a voxel are treated as closed")
+    voxel_resolution     : IntProperty(min=16, default=128, max=512, description=""\
+        "Number of voxels along the longest side of the model for the voxel pre-pass")
     vc_pre_pass_samples  : IntProperty(min=1, default=32, description=""\
         "Number of samples to render for vertex color pre-pass")
     ignore_lights        : BoolProperty(default=True, description=""\
@@ -32,7 +51,13 @@ class LUTB_OT_remove_hidden_faces(bpy.types.Operator):
     pixels_between_verts : IntProperty(min=0, default=5, description="")
     samples              : IntProperty(min=1, default=8, description=""\
         "Number of samples to render for HSR")
+    max_atlas_size       : IntProperty(min=64, default=4096, max=16384, description=""\
+        "Maximum width and height of the image faces are baked into. Models with more faces "\
+        "are baked in several tiles one after another, which bounds the memory used for baking")
     threshold            : FloatProperty(min=0, default=0.01, max=1)
+    raycast_rays         : IntProperty(min=1, default=64, description=""\
+        "Maximum number of rays cast from each face for the Ray Cast engine. "\
+        "Casting stops as soon as one ray escapes")
     use_ground_plane     : BoolProperty(default=False, description=""\
         "Add a ground plane that contributes occlusion to the model during HSR so that "\
         "the underside of the model gets removed. Before enabling this option, make "\
@@ -44,7 +69,6 @@ class LUTB_OT_remove_hidden_faces(bpy.types.Operator):
             context.object
             and context.object.type == "MESH"
             and context.mode == "OBJECT"
-            and context.scene.render.engine == "CYCLES"
         )
 
     def execute(self, context):
@@ -54,11 +78,64 @@ class LUTB_OT_remove_hidden_faces(bpy.types.Operator):
         target_obj = context.object
         mesh = target_obj.data
 
+        if self.engine == "RAYCAST":
+            known_hidden = None
+            if self.coplanar_pre_pass:
+                with stage("hsr_coplanar_pre_pass", objects=[target_obj]):
+                    known_hidden = self.compute_coplanar_pre_pass(target_obj)
+            with stage("hsr_raycast", objects=[target_obj]):
+                hidden_indices = np.where(self.compute_hidden_raycast(target_obj, known_hidden))[0]
+
+        else:
+            if scene.render.engine != "CYCLES":
+                self.report({"ERROR"}, "Baking HSR requires Cycles as the render engine!")
+                return {"CANCELLED"}
+
+            hidden_indices = self.compute_hidden_bake(context)
+            if hidden_indices is None:
+                return {"CANCELLED"}
+
+        if len(hidden_indices) > 0:
+            bpy.ops.object.mode_set(mode="EDIT")
+            context.tool_settings.mesh_select_mode = (False, False, True)
+            bpy.ops.mesh.select_all(action="DESELECT")
+            bpy.ops.object.mode_set(mode="OBJECT")
+
+            select = np.zeros(len(mesh.polygons), dtype=bool)
+            select[hidden_indices] = True
+            mesh.polygons.foreach_set("select", select)
+
+            if self.autoremove:
+                bpy.ops.object.mode_set(mode="EDIT")
+                bpy.ops.mesh.delete(type="FACE")
+                bpy.ops.mesh.select_all(action="SELECT")
+                bpy.ops.mesh.quads_convert_to_tris(quad_method="FIXED")
+                bpy.ops.object.mode_set(mode="OBJECT")
+
+            end = timer()
+            n = len(hidden_indices)
+            total = len(select)
+            operation = "removed" if self.autoremove else "found"
+            print(
+                f"hsr info: {operation} {n}/{total} hidden faces ({n / total:.2%}) "\
+                f"in {end - start:.2f}s"
+            )
+
+        else:
+            print("hsr info: found no hidden faces")
+
+        return {"FINISHED"}
+
+    def compute_hidden_bake(self, context):
+        scene = context.scene
+        target_obj = context.object
+        mesh = target_obj.data
+
         loop_counts = np.empty(len(mesh.polygons), dtype=int)
         mesh.polygons.foreach_get("loop_total", loop_counts)
         if loop_counts.max() > 4:
             self.report({"ERROR"}, "Mesh needs to consist of tris or quads only!")
-            return {"CANCELLED"}
+            return None
 
         ground_plane = None
         if self.use_ground_plane:
@@ -78,67 +155,368 @@ class LUTB_OT_remove_hidden_faces(bpy.types.Operator):
 
         scene_override = self.setup_scene_override(context)
 
+        visible = np.zeros(len(mesh.polygons), dtype=bool)
+        known_hidden = np.zeros(len(mesh.polygons), dtype=bool)
+        if self.voxel_pre_pass:
+            with stage("hsr_voxel_pre_pass", objects=[target_obj]):
+                visible, known_hidden = self.compute_voxel_pre_pass(target_obj)
+
+        if self.coplanar_pre_pass:
+            with stage("hsr_coplanar_pre_pass", objects=[target_obj]):
+                known_hidden |= self.compute_coplanar_pre_pass(target_obj)
+                visible &= ~known_hidden
+
         if self.vc_pre_pass:
-            visible = self.compute_vc_pre_pass(context, scene_override)
-            bpy.ops.object.mode_set(mode="EDIT")
-            bpy.ops.mesh.select_all(action="DESELECT")
-            bpy.ops.object.mode_set(mode="OBJECT")
-            mesh.polygons.foreach_set("select", ~visible)
-        else:
-            bpy.ops.object.mode_set(mode="EDIT")
-            bpy.ops.mesh.select_all(action="SELECT")
-            bpy.ops.object.mode_set(mode="OBJECT")
+            with stage("hsr_pre_pass", objects=[target_obj]):
+                visible |= self.compute_vc_pre_pass(context, scene_override)
+
+        bpy.ops.object.mode_set(mode="EDIT")
+        bpy.ops.mesh.select_all(action="DESELECT")
+        bpy.ops.object.mode_set(mode="OBJECT")
+        mesh.polygons.foreach_set("select", ~(visible | known_hidden))
 
         if self.tris_to_quads:
+            # hidden faces are left alone by edit mode operators, which keeps
+            # the faces found by the voxel pre-pass apart while indices change
+            mesh.polygons.foreach_set("hide", known_hidden)
             bpy.ops.object.mode_set(mode="EDIT")
             bpy.ops.mesh.tris_convert_to_quads()
             bpy.ops.object.mode_set(mode="OBJECT")
+            known_hidden = np.empty(len(mesh.polygons), dtype=bool)
+            mesh.polygons.foreach_get("hide", known_hidden)
+            mesh.polygons.foreach_set("hide", np.zeros(len(mesh.polygons), dtype=bool))
 
         select = np.empty(len(mesh.polygons), dtype=bool)
         mesh.polygons.foreach_get("select", select)
         face_indices = np.where(select)[0]
 
+        hidden_indices = [np.where(known_hidden)[0]]
         if len(face_indices) > 0:
-            image = self.bake_to_image(context, scene_override, mesh, face_indices)
-            hidden_indices = self.get_hidden_from_image(image, mesh, face_indices)
+            tile_size = self.get_atlas_size(len(face_indices))
+            tile_faces = tile_size ** 2
+            with stage("hsr_bake", objects=[target_obj], baked_faces=len(face_indices),
+                    tiles=math.ceil(len(face_indices) / tile_faces)):
+                for tile_start in range(0, len(face_indices), tile_faces):
+                    tile_indices = face_indices[tile_start:tile_start + tile_faces]
+                    image = self.bake_to_image(context, scene_override, mesh, tile_indices)
+                    hidden_indices.append(self.get_hidden_from_image(image, mesh, tile_indices))
+        hidden_indices = np.unique(np.concatenate(hidden_indices))
 
-            bpy.ops.object.mode_set(mode="EDIT")
-            context.tool_settings.mesh_select_mode = (False, False, True)
-            bpy.ops.mesh.select_all(action="DESELECT")
-            bpy.ops.object.mode_set(mode="OBJECT")
+        bpy.data.scenes.remove(scene_override)
 
-            select = np.zeros(len(mesh.polygons), dtype=bool)
-            select[hidden_indices] = True
-            mesh.polygons.foreach_set("select", select)
+        for obj in hidden_objects:
+            obj.hide_render = False
 
-            if self.autoremove:
-                bpy.ops.object.mode_set(mode="EDIT")
-                bpy.ops.mesh.delete(type="FACE")
-                bpy.ops.mesh.select_all(action="SELECT")
-                bpy.ops.mesh.quads_convert_to_tris(quad_method="FIXED")
-                bpy.ops.object.mode_set(mode="OBJECT")
+        if ground_plane:
+            bpy.data.objects.remove(ground_plane)
 
-            end = timer()
-            n = len(hidden_indices)
-            total = len(select)
-            operation = "removed" if self.autoremove else "found"
-            print(
-                f"hsr info: {operation} {n}/{total} hidden faces ({n / total:.2%}) "\
-                f"in {end - start:.2f}s"
-            )
+        return hidden_indices
+
+    # Finds hidden faces by casting rays from sample points spread over each face into the
+    # hemisphere above it. A face is visible as soon as one ray escapes the model (and the
+    # optional ground plane), it's hidden if none of them do. Only needs a BVH of the object.
+    def compute_hidden_raycast(self, obj, known_hidden=None):
+        start = timer()
+
+        faces = read_world_faces(obj)
+        co, normals = faces["co"], faces["normals"]
+        n_polys = len(normals)
+        tri_counts, tri_offsets = faces["tri_counts"], faces["tri_offsets"]
+
+        bvh_verts = co.tolist()
+        bvh_polys = [verts.tolist() for verts in np.split(faces["poly_verts"], faces["poly_offsets"][1:])]
+        if self.use_ground_plane:
+            # same box as the ground plane object used for baking
+            n = len(bvh_verts)
+            bvh_verts += [(x, y, z) for x in (-500, 500) for y in (-500, 500) for z in (-100, 0)]
+            bvh_polys += [[n + i for i in face] for face in (
+                (0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)
+            )]
+        bvh = BVHTree.FromPolygons(bvh_verts, bvh_polys)
+
+        points = get_face_samples(faces)
+        extent = np.ptp(co, axis=0).max() if len(co) else 1.0
+        points += np.repeat(normals[faces["tri_polys"]], len(FACE_SAMPLES), axis=0) * max(extent * 1e-5, 1e-6)
+
+        # stratified, cosine weighted directions, shuffled so that the first rays already
+        # cover the whole hemisphere
+        n_rays = self.raycast_rays
+        grid = math.ceil(math.sqrt(n_rays))
+        rng = np.random.default_rng(0)
+        strata = rng.permutation(grid * grid)[:n_rays]
+        strata = np.stack((strata // grid, strata % grid), axis=1)
+        ray_points = np.arange(n_rays)
+
+        hidden = np.zeros(n_polys, dtype=bool) if known_hidden is None else known_hidden.copy()
+        for batch_start in range(0, n_polys, 1024):
+            batch = np.arange(batch_start, min(batch_start + 1024, n_polys))
+
+            uv = (strata + rng.random((len(batch), n_rays, 2))) / grid
+            radius = np.sqrt(uv[..., 0])
+            angle = 2 * math.pi * uv[..., 1]
+            local = np.stack((
+                radius * np.cos(angle), radius * np.sin(angle), np.sqrt(1 - uv[..., 0])
+            ), axis=-1)
+
+            normal = normals[batch]
+            helper = np.where(np.abs(normal[:, :1]) < 0.9, (1.0, 0.0, 0.0), (0.0, 1.0, 0.0))
+            tangent = np.cross(normal, helper)
+            tangent /= np.maximum(np.linalg.norm(tangent, axis=1, keepdims=True), 1e-12)
+            bitangent = np.cross(normal, tangent)
+            directions = np.einsum("frk,fkc->frc", local, np.stack((tangent, bitangent, normal), axis=1))
+
+            n_points = tri_counts[batch] * len(FACE_SAMPLES)
+            point_indices = (tri_offsets[batch] * len(FACE_SAMPLES))[:, None] + ray_points % n_points[:, None]
+            origins = points[point_indices]
+
+            for face, face_origins, face_directions in zip(batch, origins.tolist(), directions.tolist()):
+                if faces["degenerate"][face] or hidden[face]:
+                    continue
+                for origin, direction in zip(face_origins, face_directions):
+                    if bvh.ray_cast(origin, direction)[0] is None:
+                        break
+                else:
+                    hidden[face] = True
 
+        end = timer()
+        n = hidden.sum()
+        print(
+            f"hsr info: ray cast {n_rays} rays per face, {n}/{n_polys} faces hidden "\
+            f"in {end - start:.2f}s"
+        )
+
+        return hidden
+
+    # Voxelizes the surface of the object and flood fills the air around it from the borders
+    # of the grid. Faces are checked a short distance above their surface: if that touches
+    # the outside air they're visible, if it only touches air enclosed by the model they're
+    # hidden. Everything else is left to the bake. Gaps smaller than a voxel count as closed.
+    def compute_voxel_pre_pass(self, obj):
+        start = timer()
+
+        faces = read_world_faces(obj)
+        co, normals = faces["co"], faces["normals"]
+        n_polys = len(normals)
+
+        lo, hi = co.min(axis=0), co.max(axis=0)
+        voxel = (hi - lo).max() / self.voxel_resolution
+        if voxel == 0:
+            return np.zeros(n_polys, dtype=bool), np.zeros(n_polys, dtype=bool)
+
+        # one voxel of padding on each side, so the border of the grid is outside air
+        origin = lo - voxel
+        dims = np.ceil((hi - lo) / voxel).astype(int) + 3
+        solid = np.zeros(dims, dtype=bool)
+
+        # rasterize triangles by sampling them densely enough not to skip any voxel
+        tri_co = co[faces["tris"]]
+        edge_lengths = np.linalg.norm(tri_co - np.roll(tri_co, 1, axis=1), axis=2).max(axis=1)
+        subdivisions = np.maximum(np.ceil(edge_lengths / (voxel * 0.5)).astype(int), 1)
+        for n in np.unique(subdivisions):
+            i, j = np.mgrid[:n + 1, :n + 1].reshape((2, -1))
+            inside = i + j <= n
+            i, j = i[inside] / n, j[inside] / n
+            barycentric = np.stack((1 - i - j, i, j), axis=1)
+
+            group = tri_co[subdivisions == n]
+            batch_size = max(1, 2 ** 21 // len(barycentric))
+            for batch_start in range(0, len(group), batch_size):
+                points = np.einsum("pk,tkc->tpc", barycentric, group[batch_start:batch_start + batch_size])
+                indices = ((points.reshape((-1, 3)) - origin) / voxel).astype(int)
+                solid[tuple(indices.T)] = True
+
+        if self.use_ground_plane:
+            solid[:, :, origin[2] + (np.arange(dims[2]) + 0.5) * voxel < 0] = True
+
+        exterior = np.zeros(dims, dtype=bool)
+        exterior[[0, -1]] = exterior[:, [0, -1]] = exterior[:, :, [0, -1]] = True
+        exterior &= ~solid
+
+        # Air cells between two solid cells along an axis form a run, and a run is outside air as
+        # soon as one of its cells is. Sweeping all three axes until nothing changes fills the air
+        # that's connected to the border.
+        air = ~solid
+        changed = True
+        while changed:
+            changed = False
+            for axis in range(3):
+                runs = np.cumsum(solid, axis=axis, dtype=np.int16)
+                forward = np.maximum.accumulate(np.where(exterior, runs, -1), axis=axis) == runs
+                backward = np.flip(np.maximum.accumulate(
+                    np.flip(np.where(exterior, -runs, -dims.max() - 1), axis=axis), axis=axis
+                ), axis=axis) == -runs
+                filled = (forward | backward) & air
+                if (filled != exterior).any():
+                    exterior = filled
+                    changed = True
+
+        # far enough above the face to leave the voxels its own surface occupies
+        points = get_face_samples(faces)
+        points += np.repeat(normals[faces["tri_polys"]], len(FACE_SAMPLES), axis=0) * (2 * voxel)
+        indices = np.floor((points - origin) / voxel).astype(int)
+        in_grid = ((indices >= 0) & (indices < dims)).all(axis=1)
+        indices[~in_grid] = 0
+
+        sample_exterior = exterior[tuple(indices.T)]
+        sample_interior = ~sample_exterior & air[tuple(indices.T)]
+        if self.use_ground_plane:
+            below_ground = points[:, 2] < 0
+            sample_exterior[~in_grid] = ~below_ground[~in_grid]
+            sample_interior[~in_grid] = False
         else:
-            print("hsr info: found no hidden faces")
+            sample_exterior[~in_grid] = True
+            sample_interior[~in_grid] = False
 
-        bpy.data.scenes.remove(scene_override)
+        sample_offsets = faces["tri_offsets"] * len(FACE_SAMPLES)
+        valid = ~faces["degenerate"]
+        visible = np.logical_or.reduceat(sample_exterior, sample_offsets) & valid
+        hidden = np.logical_and.reduceat(sample_interior, sample_offsets) & valid
 
-        for obj in hidden_objects:
-            obj.hide_render = False
+        end = timer()
+        print(
+            f"hsr info: voxel pre-pass at {tuple(dims.tolist())} voxels sorted out {visible.sum()} visible "\
+            f"and {hidden.sum()} hidden of {n_polys} faces in {end - start:.2f}s"
+        )
 
-        if ground_plane:
-            bpy.data.objects.remove(ground_plane)
+        return visible, hidden
 
-        return {"FINISHED"}
+    # Faces where two bricks touch lie in the same plane as a face of the other brick that
+    # points the opposite way. Planes are hashed to find such faces, then the corners of each
+    # face are looked up in a 2D grid of the opposing triangles. A face is hidden if all of
+    # its corners lie inside one convex opposing face of another brick, which means the whole
+    # face is covered. Opposing faces of the same brick, like both sides of a double sided
+    # surface, never hide each other.
+    def compute_coplanar_pre_pass(self, obj):
+        start = timer()
+
+        faces = read_world_faces(obj)
+        co, normals = faces["co"], faces["normals"]
+        n_polys = len(normals)
+        poly_verts, poly_offsets = faces["poly_verts"], faces["poly_offsets"]
+        loop_totals = np.diff(np.append(poly_offsets, len(poly_verts)))
+        hidden = np.zeros(n_polys, dtype=bool)
+        if n_polys == 0:
+            return hidden
+
+        bricks = get_face_bricks(obj.data)
+
+        extent = max(np.ptp(co, axis=0).max(), 1e-6)
+        tolerance = extent * 1e-6
+        centers = np.add.reduceat(co[poly_verts], poly_offsets) / loop_totals[:, None]
+
+        # planes pointing opposite ways get the same key and a different side
+        plane_keys = np.round(np.column_stack((
+            normals * 1e4, (normals * centers).sum(axis=1) / tolerance
+        ))).astype(np.int64)
+        nonzero = plane_keys[:, :3] != 0
+        sides = np.sign(plane_keys[np.arange(n_polys), np.argmax(nonzero, axis=1)])
+        plane_keys *= sides[:, None]
+        _, planes = np.unique(plane_keys, axis=0, return_inverse=True)
+        planes = planes.ravel()
+
+        n_planes = planes.max() + 1
+        has_front = np.bincount(planes[sides > 0], minlength=n_planes) > 0
+        has_back = np.bincount(planes[sides < 0], minlength=n_planes) > 0
+        candidates = has_front[planes] & has_back[planes] & ~faces["degenerate"]
+        if not candidates.any():
+            return hidden
+
+        # project onto the plane by dropping the axis the normal is closest to
+        dropped = np.argmax(np.abs(normals), axis=1)
+        axes = np.column_stack(((dropped + 1) % 3, (dropped + 2) % 3))
+
+        vert_faces = np.repeat(np.arange(n_polys), loop_totals)
+        corners = np.take_along_axis(co[poly_verts], axes[vert_faces], axis=1)
+
+        # corners inside a triangle fan only mean they're inside the face if the face is convex
+        next_corners = np.arange(len(poly_verts)) + 1
+        face_ends = poly_offsets + loop_totals
+        next_corners[face_ends - 1] = poly_offsets
+        edges = corners[next_corners] - corners
+        turns = cross_2d(edges, edges[next_corners])
+        convex = (
+            (np.bincount(vert_faces[turns < -tolerance ** 2], minlength=n_polys) == 0)
+            | (np.bincount(vert_faces[turns > tolerance ** 2], minlength=n_polys) == 0)
+        )
+
+        tris = faces["tris"]
+        tri_faces = faces["tri_polys"]
+        opposing = (candidates & convex)[tri_faces]
+        tris = tris[opposing]
+        tri_faces = tri_faces[opposing]
+        tri_co = np.take_along_axis(co[tris], axes[tri_faces][:, None, :], axis=2)
+
+        point_faces = vert_faces[candidates[vert_faces]]
+        points = corners[candidates[vert_faces]]
+        if not len(tris):
+            return hidden
+
+        # grid cells of about the size of a triangle, triangles are registered in every
+        # cell their bounds overlap
+        tri_min, tri_max = tri_co.min(axis=1), tri_co.max(axis=1)
+        cell = max(np.median((tri_max - tri_min).max(axis=1)), extent / 256, tolerance)
+        grid_min = np.floor(np.minimum(tri_min.min(axis=0), points.min(axis=0)) / cell).astype(np.int64)
+        grid_size = np.floor(np.maximum(tri_max.max(axis=0), points.max(axis=0)) / cell).astype(np.int64) \
+            - grid_min + 1
+        cell_min = np.floor((tri_min - tolerance) / cell).astype(np.int64) - grid_min
+        cell_max = np.floor((tri_max + tolerance) / cell).astype(np.int64) - grid_min
+        cell_min, cell_max = np.maximum(cell_min, 0), np.minimum(cell_max, grid_size - 1)
+        cell_counts = cell_max - cell_min + 1
+
+        def cell_keys(plane, side, cells):
+            return ((plane * 2 + (side > 0)) * grid_size[0] + cells[:, 0]) * grid_size[1] + cells[:, 1]
+
+        n_cells = cell_counts.prod(axis=1)
+        tri_indices = np.repeat(np.arange(len(tris)), n_cells)
+        cell_index = np.arange(n_cells.sum()) - np.repeat(np.cumsum(n_cells) - n_cells, n_cells)
+        tri_cells = cell_min[tri_indices] + np.column_stack((
+            cell_index // cell_counts[tri_indices, 1], cell_index % cell_counts[tri_indices, 1]
+        ))
+        keys = cell_keys(planes[tri_faces[tri_indices]], sides[tri_faces[tri_indices]], tri_cells)
+        order = np.argsort(keys, kind="stable")
+        keys, tri_indices = keys[order], tri_indices[order]
+
+        # look up the opposing triangles in the cell of every corner
+        point_cells = np.clip(np.floor(points / cell).astype(np.int64) - grid_min, 0, grid_size - 1)
+        point_keys = cell_keys(planes[point_faces], -sides[point_faces], point_cells)
+        first = np.searchsorted(keys, point_keys, side="left")
+        counts = np.searchsorted(keys, point_keys, side="right") - first
+
+        pair_points = np.repeat(np.arange(len(points)), counts)
+        pair_tris = tri_indices[
+            np.repeat(first, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        ]
+        pair_faces = tri_faces[pair_tris]
+
+        other_brick = bricks[point_faces[pair_points]] != bricks[pair_faces]
+        pair_points, pair_tris, pair_faces = pair_points[other_brick], pair_tris[other_brick], pair_faces[other_brick]
+
+        # inside or on the border of the triangle, edges are oriented counter clockwise
+        a, b, c = tri_co[pair_tris, 0], tri_co[pair_tris, 1], tri_co[pair_tris, 2]
+        p = points[pair_points]
+        area = cross_2d(b - a, c - a)
+        distances = np.column_stack([
+            cross_2d(v - u, p - u) / np.maximum(np.linalg.norm(v - u, axis=1), tolerance)
+            for u, v in ((a, b), (b, c), (c, a))
+        ]) * np.sign(area)[:, None]
+        inside = (area != 0) & (distances >= -tolerance).all(axis=1)
+
+        # a corner can be inside several triangles of the same face, count it once per face
+        covering = np.unique(np.column_stack((pair_points[inside], pair_faces[inside])), axis=0)
+        face_pairs, covered_corners = np.unique(
+            np.column_stack((point_faces[covering[:, 0]], covering[:, 1])), axis=0, return_counts=True
+        )
+        covered = face_pairs[covered_corners == loop_totals[face_pairs[:, 0]], 0]
+        hidden[covered] = True
+
+        end = timer()
+        n = hidden.sum()
+        print(
+            f"hsr info: coplanar pre-pass found {n}/{n_polys} hidden faces ({n / n_polys:.2%}) "\
+            f"in {end - start:.2f}s"
+        )
+
+        return hidden
 
     def add_ground_plane(self, context):
         bm = bmesh.new()
@@ -212,7 +590,7 @@ class LUTB_OT_remove_hidden_faces(bpy.types.Operator):
         for i, material in enumerate(original_materials):
             obj.material_slots[i].material = material
 
-        vc_data = np.empty(len(mesh.loops) * 4)
+        vc_data = np.empty(len(mesh.loops) * 4, dtype=np.float32)
         vc.data.foreach_get("color", vc_data)
 
         mesh.vertex_colors.remove(vc)
@@ -224,10 +602,9 @@ class LUTB_OT_remove_hidden_faces(bpy.types.Operator):
         loop_totals = np.empty(len(mesh.polygons), dtype=int)
         mesh.polygons.foreach_get("loop_total", loop_totals)
 
-        face_loop_values = np.zeros((len(mesh.polygons), 4), dtype=bool)
-        for i, (loop_start, loop_total) in enumerate(zip(loop_starts, loop_totals)):
-            face_loop_values[i,:loop_total] = loop_values[loop_start:loop_start + loop_total]
-        visible = face_loop_values.max(axis=1)
+        # loops of all polygons in polygon order, so every polygon is one contiguous slice
+        poly_loops, poly_offsets = get_poly_loops(loop_starts, loop_totals)
+        visible = np.maximum.reduceat(loop_values[poly_loops], poly_offsets)
 
         end = timer()
         n = visible.sum()
@@ -251,8 +628,7 @@ class LUTB_OT_remove_hidden_faces(bpy.types.Operator):
             np.array((0, 1)) + np.array((-0.01, 1.01)) * pbv_p_1,
         )) / size_pixels
 
-        size_inv = 1 / size
-        uv_data = np.zeros((len(mesh.loops), 2))
+        uv_data = np.zeros((len(mesh.loops), 2), dtype=np.float32)
         loop_starts = np.empty(len(mesh.polygons), dtype=int)
         mesh.polygons.foreach_get("loop_start", loop_starts)
         loop_starts = loop_starts[face_indices]
@@ -260,18 +636,27 @@ class LUTB_OT_remove_hidden_faces(bpy.types.Operator):
         mesh.polygons.foreach_get("loop_total", loop_totals)
         loop_totals = loop_totals[face_indices]
 
-        for i, (loop_start, loop_total) in enumerate(zip(loop_starts, loop_totals)):
-            target = np.array((i % size, i // size)) * size_inv
-            uv_data[loop_start:loop_start+loop_total] = target + offsets[:loop_total]
-        uv_layer.data.foreach_set("uv", uv_data.flatten())
+        # the i-th face gets the quadrant in column i % size and row i // size
+        poly_loops, poly_offsets = get_poly_loops(loop_starts, loop_totals)
+        faces = np.repeat(np.arange(len(face_indices)), loop_totals)
+        corners = np.arange(len(poly_loops)) - np.repeat(poly_offsets, loop_totals)
+        targets = np.column_stack((faces % size, faces // size)) / size
+        uv_data[poly_loops] = targets + offsets[corners]
+        uv_layer.data.foreach_set("uv", uv_data.ravel())
 
         return uv_layer
 
+    # number of faces along each side of an atlas, limited by max_atlas_size
+    def get_atlas_size(self, face_count):
+        quadrant_size = 2 + self.pixels_between_verts
+        return max(1, min(math.ceil(math.sqrt(face_count)), self.max_atlas_size // quadrant_size))
+
+    # faces that aren't part of the atlas keep UVs of (0, 0) and cover no pixels
     def bake_to_image(self, context, scene, mesh, face_indices):
         obj = context.object
         mesh = context.object.data
 
-        size = math.ceil(math.sqrt(len(face_indices)))
+        size = self.get_atlas_size(len(face_indices))
         quadrant_size = 2 + self.pixels_between_verts
         size_pixels = size * quadrant_size
 
@@ -310,27 +695,17 @@ class LUTB_OT_remove_hidden_faces(bpy.types.Operator):
     def get_hidden_from_image(self, image, mesh, face_indices):
         face_count = len(face_indices)
 
-        size = math.ceil(math.sqrt(face_count))
+        size = self.get_atlas_size(face_count)
         quadrant_size = 2 + self.pixels_between_verts
         size_pixels = size * quadrant_size
-        size_sq = size ** 2
-        size_pixels_sq = size_pixels ** 2
 
-        pixels = np.empty(size_pixels_sq * 4, dtype=np.float32)
+        pixels = np.empty(size_pixels ** 2 * 4, dtype=np.float32)
         image.pixels.foreach_get(pixels)
 
-        sum_per_face = pixels.copy()
-        sum_per_face = np.reshape(sum_per_face, (size_pixels_sq, 4))
-        sum_per_face = np.delete(sum_per_face, 3, 1)
-        sum_per_face = np.reshape(sum_per_face, (size_pixels_sq // quadrant_size, quadrant_size * 3))
-        sum_per_face = np.sum(sum_per_face, axis=1)
-        sum_per_face = np.reshape(sum_per_face, (size_pixels, size))
-        sum_per_face = np.swapaxes(sum_per_face, 0, 1)
-        sum_per_face = np.reshape(sum_per_face, (size_sq, quadrant_size))
-        sum_per_face = np.sum(sum_per_face, axis=1)
-        sum_per_face = np.reshape(sum_per_face, (size, size))
-        sum_per_face = np.swapaxes(sum_per_face, 0, 1)
-        sum_per_face = np.reshape(sum_per_face, (1, size_sq))[0][:face_count]
+        # pixels are stored row by row, the i-th face's quadrant is in row i // size and
+        # column i % size. Summing over views of the buffer doesn't copy it.
+        pixels = pixels.reshape((size, quadrant_size, size, quadrant_size, 4))
+        sum_per_face = pixels[..., :3].sum(axis=(1, 3, 4)).ravel()[:face_count]
 
         pixels_per_quad = quadrant_size ** 2
         pixels_per_tri  = (pixels_per_quad + quadrant_size) / 2
@@ -345,6 +720,95 @@ class LUTB_OT_remove_hidden_faces(bpy.types.Operator):
 
         return indices
 
+# stratified barycentric coordinates of the points sampled on every triangle of a face
+FACE_SAMPLES = np.array((
+    (1 / 3, 1 / 3, 1 / 3),
+    (2 / 3, 1 / 6, 1 / 6),
+    (1 / 6, 2 / 3, 1 / 6),
+    (1 / 6, 1 / 6, 2 / 3),
+))
+
+# indices of the loops of the given polygons in polygon order, and where each polygon starts in them
+def get_poly_loops(loop_starts, loop_totals):
+    poly_offsets = np.cumsum(loop_totals) - loop_totals
+    poly_loops = np.arange(loop_totals.sum()) + np.repeat(loop_starts - poly_offsets, loop_totals)
+    return poly_loops, poly_offsets
+
+# World space vertices and face normals of an object, with every face split into the triangle
+# fan of its loops. Triangles are ordered by face.
+def read_world_faces(obj):
+    mesh = obj.data
+    n_polys = len(mesh.polygons)
+
+    matrix = np.array(obj.matrix_world)
+    co = np.empty(len(mesh.vertices) * 3)
+    mesh.vertices.foreach_get("co", co)
+    co = co.reshape((-1, 3)) @ matrix[:3, :3].T + matrix[:3, 3]
+
+    normals = np.empty(n_polys * 3)
+    mesh.polygons.foreach_get("normal", normals)
+    normals = normals.reshape((-1, 3)) @ np.linalg.inv(matrix[:3, :3])
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    normals = np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+
+    loop_starts = np.empty(n_polys, dtype=int)
+    mesh.polygons.foreach_get("loop_start", loop_starts)
+    loop_totals = np.empty(n_polys, dtype=int)
+    mesh.polygons.foreach_get("loop_total", loop_totals)
+    vertex_indices = np.empty(len(mesh.loops), dtype=int)
+    mesh.loops.foreach_get("vertex_index", vertex_indices)
+
+    poly_loops, poly_offsets = get_poly_loops(loop_starts, loop_totals)
+    poly_verts = vertex_indices[poly_loops]
+
+    tri_counts = loop_totals - 2
+    tri_offsets = np.cumsum(tri_counts) - tri_counts
+    tri_polys = np.repeat(np.arange(n_polys), tri_counts)
+    tri_corners = np.arange(tri_counts.sum()) - np.repeat(tri_offsets, tri_counts)
+    tri_first = poly_offsets[tri_polys]
+    tris = np.stack((
+        poly_verts[tri_first],
+        poly_verts[tri_first + tri_corners + 1],
+        poly_verts[tri_first + tri_corners + 2],
+    ), axis=1)
+
+    return {
+        "co": co,
+        "normals": normals,
+        "degenerate": lengths[:, 0] == 0,
+        "poly_verts": poly_verts,
+        "poly_offsets": poly_offsets,
+        "tris": tris,
+        "tri_polys": tri_polys,
+        "tri_counts": tri_counts,
+        "tri_offsets": tri_offsets,
+    }
+
+def cross_2d(u, v):
+    return u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0]
+
+# Index of the brick every face belongs to. Combined objects store it in a face layer, for
+# other meshes each connected part counts as a brick.
+def get_face_bricks(mesh):
+    n_polys = len(mesh.polygons)
+    if layer := mesh.polygon_layers_int.get(BRICK_LAYER):
+        bricks = np.empty(n_polys, dtype=np.int32)
+        layer.data.foreach_get("value", bricks)
+        return bricks
+
+    edges = np.empty(len(mesh.edges) * 2, dtype=np.int32)
+    mesh.edges.foreach_get("vertices", edges)
+    components = connected_components(len(mesh.vertices), edges.reshape((-1, 2)))
+    loop_starts = np.empty(n_polys, dtype=np.int32)
+    mesh.polygons.foreach_get("loop_start", loop_starts)
+    vertex_indices = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", vertex_indices)
+    return components[vertex_indices[loop_starts]]
+
+# FACE_SAMPLES points on every triangle returned by read_world_faces, ordered by face
+def get_face_samples(faces):
+    return np.einsum("pk,tkc->tpc", FACE_SAMPLES, faces["co"][faces["tris"]]).reshape((-1, 3))
+
 def get_overexposed_material(image):
     material = bpy.data.materials.get(LUTB_HSR_ID)
     if material and (not material.use_nodes or not "LUTB_TARGET" in material.node_tree.nodes):
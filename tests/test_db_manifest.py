@@ -0,0 +1,45 @@
+import os
+
+import pytest
+
+pytest.importorskip("bpy")
+
+from lu_toolbox import importldd
+
+
+def make_db(root):
+    os.makedirs(os.path.join(root, "Primitives", "LOD0"))
+    for path in ("Primitives/3001.xml", "Primitives/LOD0/3001.g", "Primitives/LOD0/3001.g1"):
+        with open(os.path.join(root, path), "wb") as file:
+            file.write(b"")
+
+
+def test_second_reader_reuses_manifest(tmp_path, monkeypatch):
+    make_db(str(tmp_path))
+
+    first = importldd.DBFolderReader(str(tmp_path))
+    assert os.path.exists(first.manifestPath())
+
+    def fail():
+        raise AssertionError("manifest was rebuilt")
+
+    monkeypatch.setattr(importldd.DBFolderReader, "buildManifest", lambda self: fail())
+    second = importldd.DBFolderReader(str(tmp_path))
+
+    assert second.filelist.keys() == first.filelist.keys()
+    assert second.geometryFiles("3001", None)[1].name.endswith("3001.g1")
+
+
+def test_manifest_is_rebuilt_when_files_change(tmp_path):
+    make_db(str(tmp_path))
+    importldd.DBFolderReader(str(tmp_path))
+
+    path = os.path.join(str(tmp_path), "Primitives", "3002.xml")
+    with open(path, "wb") as file:
+        file.write(b"")
+    # make sure the directory mtime differs even on coarse grained file systems
+    stat = os.stat(os.path.dirname(path))
+    os.utime(os.path.dirname(path), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    reader = importldd.DBFolderReader(str(tmp_path))
+    assert "3002" in reader.primitives